@@ -0,0 +1,143 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterator, Set, Tuple
+from loguru import logger
+from web3 import Web3
+import csv
+import json
+import multiprocessing
+import os
+import time
+import config
+
+
+# one entry per address: {"address", "chain", "block"}, chain/block default to the command line ones.
+# JSONL: {"address": ..., "chain": ..., "block": ...} per line
+# CSV: a header with at least an "address" column, or one address per line
+def read_batch_file(path:str, chain:str, block:int) -> Iterator[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.endswith(".jsonl") or path.endswith(".json"):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            lines = [line for line in f if line.strip() and not line.startswith("#")]
+            if lines and "address" in lines[0].lower():
+                rows = csv.DictReader(lines)
+            else:
+                rows = ({"address": line.split(",")[0]} for line in lines)
+        for row in rows:
+            address = (row.get("address") or "").strip()
+            if not Web3.is_address(address):
+                logger.warning(f"skip invalid address in {path}: {address!r}")
+                continue
+            row_chain = (row.get("chain") or chain or "").strip()
+            if not row_chain:
+                logger.warning(f"skip {address} in {path}: no chain in the file and no --chain")
+                continue
+            row_block = row.get("block")
+            yield {
+                "address": Web3.to_checksum_address(address),
+                "chain": row_chain,
+                "block": int(row_block) if row_block not in (None, "") else block,
+            }
+
+
+def entry_key(entry:Dict[str, Any]) -> Tuple[str, int, str]:
+    return (entry["chain"], entry["block"], entry["address"].lower())
+
+
+# entries already analyzed in a previous run with the same output file
+def completed_entries(output:str) -> Set[Tuple[str, int, str]]:
+    completed = set()
+    if not os.path.exists(output):
+        return completed
+    with open(output, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of a crashed run
+                continue
+            if result.get("status") == "ok":
+                completed.add(entry_key(result))
+    return completed
+
+
+def analyze_entry(entry:Dict[str, Any]) -> Dict[str, Any]:
+    from Contract import analyze_functions, load_online_contract, selected_functions
+    from Helper import get_helper
+    start = time.time()
+    result = dict(entry)
+    try:
+        helper = get_helper(entry["chain"], entry["block"])
+        fcontract = load_online_contract(helper, entry["address"])
+        result["contract"] = fcontract.main_name
+        result["functions"] = analyze_functions(fcontract, selected_functions(fcontract))
+        result["status"] = "ok"
+    except Exception as e:
+        logger.error(f"Failed to analyze {entry['address']}: {e}")
+        result["status"] = "error"
+        result["error"] = str(e)
+    result["seconds"] = round(time.time() - start, 3)
+    return result
+
+
+def make_executor() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=config.batch_workers, mp_context=multiprocessing.get_context("fork"))
+
+
+# entries of the batch file not analyzed yet, each address once
+def pending_entries(path:str, chain:str, block:int, completed:Set[Tuple[str, int, str]]) -> Iterator[Dict[str, Any]]:
+    seen = set(completed)
+    for entry in read_batch_file(path, chain, block):
+        key = entry_key(entry)
+        if key in seen:
+            continue
+        seen.add(key)
+        yield entry
+
+
+# analyze the addresses of a batch file over config.batch_workers processes, appending one JSON line per address to output
+def BatchBuild(path:str, output:str, chain:str=None, block:int=-1):
+    completed = completed_entries(output)
+    if completed:
+        logger.info(f"resuming {path}: {len(completed)} addresses already analyzed")
+
+    done = failed = 0
+    executor = make_executor()
+    with open(output, "a", encoding="utf-8") as out:
+        # future -> entry
+        pending = {}
+
+        def collect(finished):
+            nonlocal done, failed
+            for future in finished:
+                entry = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # the worker died (e.g., out of memory), the entry is retried on resume
+                    result = dict(entry, status="error", error=f"worker failed: {e}")
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+                done += 1
+                failed += result["status"] != "ok"
+
+        try:
+            for entry in pending_entries(path, chain, block, completed):
+                # bounded queue: never read far ahead of the workers
+                if len(pending) >= 2 * config.batch_workers:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+                try:
+                    future = executor.submit(analyze_entry, entry)
+                except BrokenProcessPool:
+                    # a worker died: the entries it took down are recorded as failed, the rest go to a new pool
+                    logger.warning("batch worker pool broken, restarting it")
+                    collect(wait(pending).done)
+                    executor.shutdown(wait=False)
+                    executor = make_executor()
+                    future = executor.submit(analyze_entry, entry)
+                pending[future] = entry
+            collect(wait(pending).done)
+        finally:
+            executor.shutdown()
+    logger.info(f"batch {path}: {done} addresses analyzed ({failed} failed), results in {output}")
@@ -0,0 +1,218 @@
+from typing import Any, Dict, List, Optional, Tuple
+from z3 import *
+from FFormula import Simplify
+import json
+import os
+
+
+# effect of a function on a state variable, as in Template/output_json/AEST/aest.json
+INCREASE, DECREASE, RESET, NOEFFECT, CHANGE = "increase", "decrease", "reset", "noeffect", "change"
+
+
+def is_literal(exp:ExprRef) -> bool:
+    return is_int_value(exp) or is_bv_value(exp) or is_true(exp) or is_false(exp) or is_string_value(exp)
+
+
+# one solver for every query of a function: the non-negativity axioms are added once,
+# each query is a push/check/pop, and repeated queries are answered from memory
+class EffectClassifier:
+    def __init__(self, axioms:List[ExprRef]=None):
+        self.solver = Solver()
+        self.solver.add(*(axioms or []))
+        # hashes of the assertions -> (assertions, result)
+        self.results: Dict[Tuple[int, ...], Tuple[Tuple[ExprRef, ...], CheckSatResult]] = {}
+        self.queries = 0
+
+
+    def check(self, *assertions:ExprRef) -> CheckSatResult:
+        key = tuple(assertion.hash() for assertion in assertions)
+        cached = self.results.get(key)
+        # hash collision
+        if cached is not None and all(a.eq(b) for a, b in zip(cached[0], assertions)):
+            return cached[1]
+        self.queries += 1
+        self.solver.push()
+        self.solver.add(*assertions)
+        result = self.solver.check()
+        self.solver.pop()
+        self.results[key] = (assertions, result)
+        return result
+
+
+    # cons implies claim
+    def valid(self, cons:ExprRef, claim:ExprRef) -> bool:
+        return self.check(cons, Not(claim)) == unsat
+
+
+    # effect of exp (the value at the end of the function when cons holds) with respect to old (the pre-state), None if the path is infeasible
+    def classify_entry(self, exp:ExprRef, cons:ExprRef, old:Optional[ExprRef]) -> Optional[str]:
+        if self.check(cons) == unsat:
+            return None
+        exp = Simplify(exp)
+        if old is None or not exp.sort().eq(old.sort()):
+            return RESET if is_literal(exp) else CHANGE
+        if self.valid(cons, exp == old):
+            return NOEFFECT
+        if is_literal(exp):
+            return RESET
+        if is_arith(exp):
+            if self.valid(cons, exp >= old):
+                return INCREASE
+            if self.valid(cons, exp <= old):
+                return DECREASE
+        return CHANGE
+
+
+    # one effect over all paths, None if no path reaches the variable
+    def classify(self, entries:List[Tuple[ExprRef, ExprRef]], old:Optional[ExprRef]) -> Optional[str]:
+        effects = {self.classify_entry(exp, cons, old) for exp, cons in entries} - {None}
+        if not effects:
+            return None
+        return join_effects(*effects)
+
+
+def join_effects(*effects:str) -> str:
+    changed = set(effects) - {NOEFFECT}
+    if not changed:
+        return NOEFFECT
+    # e.g., increased on one path and unchanged on the other
+    return changed.pop() if len(changed) == 1 else CHANGE
+
+
+# the term the variable had before the function: the symbol (or map cell) named like the state variable
+def pre_state(name:str, indexes:List[Any], entries:List[Tuple[ExprRef, ExprRef]]) -> Optional[ExprRef]:
+    # the cell as the function read it
+    for exp, _ in entries:
+        found = _find_cell(exp, name, indexes)
+        if found is not None:
+            return found
+    if not entries or not all(is_expr(index) for index in indexes):
+        return None
+    # written without being read: rebuild the cell the way Function.handleMapType does
+    sort = entries[0][0].sort()
+    for index in reversed(indexes[1:]):
+        sort = ArraySort(index.sort(), sort)
+    if not indexes:
+        return Const(name, sort)
+    term = Array(name, indexes[0].sort(), sort)
+    for index in indexes:
+        term = Select(term, index)
+    return term
+
+
+def _find_cell(exp:ExprRef, name:str, indexes:List[Any]) -> Optional[ExprRef]:
+    visited = set()
+    stack = [exp]
+    while stack:
+        term = stack.pop()
+        if term.get_id() in visited:
+            continue
+        visited.add(term.get_id())
+        if _is_cell(term, name, indexes):
+            return term
+        stack.extend(term.children())
+    return None
+
+
+def _is_cell(term:ExprRef, name:str, indexes:List[Any]) -> bool:
+    for index in reversed(indexes):
+        if not is_select(term):
+            return False
+        if is_expr(index) and not term.arg(1).eq(index):
+            return False
+        term = term.arg(0)
+    return is_const(term) and term.decl().kind() == Z3_OP_UNINTERPRETED and term.decl().name() == name
+
+
+# the "functions" entry of aest.json for one analyzed function:
+#   scalar of the analyzed contract: {var: effect}, of another contract: {var: {contract: effect}}
+#   map cell: {var: {index: ... {contract: effect}}}
+def classify_function(ffunc, context) -> Dict[str, Any]:
+    classifier = EffectClassifier([Int(name) >= 0 for name in sorted(ffunc.nonneg_symbols)])
+    addresses = _known_addresses(ffunc)
+    effects: Dict[str, Any] = {}
+    for name, indexes, fformula in ffunc.formatFFormulaMap(context):
+        entries = list(fformula.expressions_with_constraints)
+        effect = classifier.classify(entries, pre_state(name, indexes, entries))
+        if effect is None or effect == NOEFFECT:
+            continue
+        contract = fformula.stateVar.contract
+        if not indexes:
+            if contract is ffunc.parent_contract:
+                effects[name] = join_effects(effects[name], effect) if isinstance(effects.get(name), str) else effect
+                continue
+            node = effects.setdefault(name, {})
+        else:
+            node = effects.setdefault(name, {})
+            for index in indexes:
+                node = node.setdefault(_index_name(index, ffunc, addresses), {})
+        node[contract.main_name] = join_effects(node[contract.main_name], effect) if contract.main_name in node else effect
+    return effects
+
+
+# address of this -> how the contract is named in an index
+def _known_addresses(ffunc) -> Dict[int, str]:
+    addresses = {}
+    for contract in [ffunc.parent_contract] + list(ffunc.parent_contract.online_helper.cached_contracts.values()):
+        try:
+            addresses.setdefault(contract.address_this.as_long(), contract.main_name)
+        except AttributeError:
+            continue
+    addresses[ffunc.parent_contract.address_this.as_long()] = "this"
+    return addresses
+
+
+def _index_name(index:Any, ffunc, addresses:Dict[int, str]) -> str:
+    if not is_expr(index):
+        return str(index)
+    index = Simplify(index)
+    if is_bv_value(index) and index.as_long() in addresses:
+        return addresses[index.as_long()]
+    return str(index)
+
+
+# aest.json of a contract from the results of its functions; overloaded functions are named by their full name
+def effects_document(contract_name:str, results:List[Dict[str, Any]]) -> Dict[str, Any]:
+    names = [result["function"].split(".", 1)[-1].split("(")[0] for result in results]
+    functions = {}
+    for name, result in zip(names, results):
+        if "effects" not in result:
+            continue
+        key = name if names.count(name) == 1 else result["function"].split(".", 1)[-1]
+        functions[key] = result["effects"]
+    return {"contract": contract_name, "functions": functions}
+
+
+def write_effects(directory:str, contract_name:str, results:List[Dict[str, Any]]) -> str:
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{contract_name.lower()}.json")
+    with open(path, "w") as f:
+        json.dump(effects_document(contract_name, results), f, indent=2)
+    return path
+
+
+# ==================================== test ============================================
+
+def test_EffectClassifier():
+    balance = Array("balanceOf", BitVecSort(160), IntSort())
+    to, sender = BitVec("to", 160), BitVec("msg.sender", 160)
+    amount, fee, total = Int("amount"), Int("swapFeeTotal"), Int("totalSupply")
+    classifier = EffectClassifier([amount >= 0, fee >= 0, total >= 0, Select(balance, to) >= 0, Select(balance, sender) >= 0])
+    cell = Select(balance, to)
+    assert pre_state("balanceOf", [to], [(cell + amount, BoolVal(True))]).eq(cell)
+    assert classifier.classify([(cell + amount, to != sender)], cell) == INCREASE
+    assert classifier.classify([(Select(balance, sender) - amount, Select(balance, sender) >= amount)], Select(balance, sender)) == DECREASE
+    assert classifier.classify([(IntVal(0), BoolVal(True))], fee) == RESET
+    assert classifier.classify([(fee, BoolVal(True))], fee) == NOEFFECT
+    assert classifier.classify([(total + amount, amount > 5), (total - amount, amount <= 5)], total) == CHANGE
+    # infeasible paths do not count
+    assert classifier.classify([(total + amount, amount < 0)], total) is None
+    # written without being read
+    assert pre_state("balanceOf", [to], [(IntVal(5), BoolVal(True))]).eq(cell)
+    assert effects_document("AEST", [{"function": "AEST.burn(uint256)", "effects": {"totalSupply": DECREASE}}]) == {"contract": "AEST", "functions": {"burn": {"totalSupply": DECREASE}}}
+    print(f"{classifier.queries} solver queries")
+    return
+
+
+if __name__ == "__main__":
+    test_EffectClassifier()
@@ -0,0 +1,204 @@
+from typing import Dict, List, Optional
+from crytic_compile import CryticCompile
+from crytic_compile.utils.zip import load_from_zip, save_to_zip
+from loguru import logger
+from slither.slither import Slither
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import config
+
+
+# solc binary -> version, `solc --version` is asked once per binary
+_solc_versions: Dict[str, str] = {}
+
+
+def solc_version(solc:str="solc") -> str:
+    if solc not in _solc_versions:
+        try:
+            output = subprocess.run([solc, "--version"], capture_output=True, text=True, check=True).stdout
+            match = re.search(r"Version:\s*([0-9]+\.[0-9]+\.[0-9]+)", output)
+            _solc_versions[solc] = match.group(1) if match else "unknown"
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"Failed to get the version of {solc}: {e}")
+            _solc_versions[solc] = "unknown"
+    return _solc_versions[solc]
+
+
+# version -> solc binary, so that contracts of different versions compile side by side without `solc-select use`
+_solc_binaries: Dict[str, str] = {}
+_solc_install_lock = threading.Lock()
+
+
+def _find_solc(version:str) -> Optional[str]:
+    candidates = [os.path.join(directory, f"solc-{version}") for directory in config.solc_dirs]
+    try:
+        from solc_select.solc_select import artifact_path
+        candidates.insert(0, str(artifact_path(version)))
+    except ImportError:
+        pass
+    # py-solc-x, and binaries named by version on PATH
+    candidates += [os.path.expanduser(f"~/.solcx/solc-v{version}"), shutil.which(f"solc-{version}")]
+    for candidate in candidates:
+        if candidate and os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+# the binary of solc `version` (e.g. 0.8.19), installed through solc-select's API when missing and config.solc_install
+def solc_binary(version:str) -> Optional[str]:
+    if version in _solc_binaries:
+        return _solc_binaries[version]
+    with _solc_install_lock:
+        path = _find_solc(version)
+        if path is None and config.solc_install:
+            try:
+                from solc_select.solc_select import install_artifacts
+                logger.info(f"installing solc {version}")
+                install_artifacts([version], silent=True)
+            except Exception as e:
+                logger.error(f"Failed to install solc version {version}: {e}")
+            path = _find_solc(version)
+        if path is not None:
+            _solc_binaries[version] = path
+            _solc_versions[path] = version
+    return path
+
+
+def file_digest(path:str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# crytic-compile results on disk: <key>.zip (the compilation) and <key>.json (the sources it was built from),
+# key = sha256(compiler version, compile options, content of the main source file)
+class CompileCache:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+
+    # compile_cache is created at import, before main.py applies --no_compile_cache to config.compile_cache_dir
+    @property
+    def cache_dir(self) -> str:
+        return config.compile_cache_dir
+
+
+    @property
+    def max_bytes(self) -> int:
+        return config.compile_cache_size
+
+
+    def key(self, path:str, version:str, options:str="") -> str:
+        digest = hashlib.sha256(version.encode())
+        digest.update(options.encode())
+        with open(path, "rb") as f:
+            digest.update(f.read())
+        return digest.hexdigest()
+
+
+    def load(self, path:str, version:str, options:str="") -> Optional[CryticCompile]:
+        key = self.key(path, version, options)
+        archive = os.path.join(self.cache_dir, f"{key}.zip")
+        manifest = os.path.join(self.cache_dir, f"{key}.json")
+        if not os.path.exists(archive) or not os.path.exists(manifest):
+            self.misses += 1
+            return None
+        try:
+            with open(manifest, "r") as f:
+                sources = json.load(f)["sources"]
+            # an imported file changed since
+            if any(not os.path.exists(source) or file_digest(source) != digest for source, digest in sources.items()):
+                self.misses += 1
+                return None
+            crytic = load_from_zip(archive)[0]
+        except Exception as e:
+            logger.warning(f"Broken compile cache entry {key}: {e}")
+            self.remove(key)
+            self.misses += 1
+            return None
+        # last use, for the eviction
+        os.utime(archive)
+        self.hits += 1
+        return crytic
+
+
+    def store(self, path:str, version:str, crytic:CryticCompile, options:str=""):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        key = self.key(path, version, options)
+        sources = {}
+        for filename in crytic.filenames:
+            if os.path.exists(filename.absolute):
+                sources[filename.absolute] = file_digest(filename.absolute)
+        # write to temporary names first, so that a concurrent run (or thread) never sees half an entry
+        archive = os.path.join(self.cache_dir, f"{key}.zip")
+        manifest = os.path.join(self.cache_dir, f"{key}.json")
+        suffix = f"{os.getpid()}.{threading.get_ident()}.tmp"
+        save_to_zip([crytic], f"{archive}.{suffix}")
+        with open(f"{manifest}.{suffix}", "w") as f:
+            json.dump({"path": os.path.abspath(path), "version": version, "sources": sources}, f)
+        os.replace(f"{archive}.{suffix}", archive)
+        os.replace(f"{manifest}.{suffix}", manifest)
+        self.evict()
+
+
+    def remove(self, key:str):
+        for suffix in (".zip", ".json"):
+            try:
+                os.remove(os.path.join(self.cache_dir, f"{key}{suffix}"))
+            except FileNotFoundError:
+                pass
+
+
+    # drop the least recently used entries until the archives fit in max_bytes
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".zip"):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name[:-len(".zip")]))
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logger.debug(f"[C] evict compile cache entry {key}")
+            self.remove(key)
+            total -= size
+
+
+    def __str__(self):
+        return f"compile cache: {self.hits} hits, {self.misses} misses"
+
+
+compile_cache = CompileCache()
+
+
+# ==============================================================================================================
+# export functions:
+
+# Slither(path), reusing the compilation of an identical source compiled by the same solc version
+# working_dir: solc runs there and path is relative to it
+def load_slither(path:str, version:str=None, solc:str="solc", working_dir:str=None, remappings:List[str]=None) -> Slither:
+    kwargs = {"solc": solc}
+    if working_dir:
+        kwargs["solc_working_dir"] = working_dir
+    if remappings:
+        kwargs["solc_remaps"] = remappings
+    if not config.compile_cache_dir:
+        return Slither(path, **kwargs)
+    version = version or solc_version(solc)
+    source_path = os.path.join(working_dir, path) if working_dir else path
+    options = json.dumps({"path": path, "remappings": remappings or []})
+    crytic = compile_cache.load(source_path, version, options)
+    if crytic is None:
+        crytic = CryticCompile(path, **kwargs)
+        try:
+            compile_cache.store(source_path, version, crytic, options)
+        except Exception as e:
+            logger.warning(f"Failed to cache the compilation of {path}: {e}")
+    logger.debug(f"[C] {path} (solc {version}), {compile_cache}")
+    return Slither(crytic)
@@ -1,11 +1,19 @@
+import asyncio
 import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from loguru import logger
-from slither.slither import Slither
 from slither.core.declarations.contract import Contract
-from typing import List
+from slither.core.variables import StateVariable
+from slither.slithir.operations import HighLevelCall, LibraryCall, TypeConversion
+from slither.slithir.variables import Constant
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 from z3 import BitVecVal
-from Function import FFunction
-from Helper import OnlineHelper
+from Classify import classify_function, write_effects
+from Compiler import load_slither
+from Function import FFunction, print_formula_map, print_highlevel_calls
+from Helper import OnlineHelper, get_helper
+from Output import write_result
 from web3 import Web3
 import config
 
@@ -19,10 +27,11 @@ class FContract:
         if config.mode == "online":
             self.online_helper = online_helper
         else:
-            self.online_helper = OnlineHelper("bnb", -1)
+            self.online_helper = get_helper("offline", -1)
         if config.mode == "online":
             self.address = address
             self._address_this = BitVecVal(int(address, 16), 160)
+            self.online_helper.prefetch_getters(sli_contract, address)
         else:
             self._address_this = self.fakeThisAddress()
 
@@ -51,27 +60,166 @@ class FContract:
 
 
 
+# ================================================================
+# per-function analysis
+
+def selected_functions(fcontract:FContract):
+    return [func for func in fcontract.sli_contract.functions if config.functions is None or func.canonical_name in config.functions]
+
+
+def analyze_function(fcontract:FContract, canonical_name:str) -> Dict[str, Any]:
+    func = next(func for func in fcontract.sli_contract.functions if func.canonical_name == canonical_name)
+    ffunc = FFunction(func, fcontract)
+    logger.debug(f"[F] function name:  {ffunc.func.canonical_name}")
+    try:
+        context = ffunc.run()
+    except Exception as e:
+        logger.error(f"Failed to analyze {canonical_name}: {e}")
+        return {"contract": fcontract.main_name, "function": canonical_name, "error": str(e)}
+    result = ffunc.serializeFFormulaMap(context)
+    if config.effects_dir:
+        result["effects"] = classify_function(ffunc, context)
+    return result
+
+
+# the contract being analyzed by the pool, inherited by the forked workers (slither objects are not picklable)
+_pool_contract: FContract = None
+
+
+def _analyze_in_worker(canonical_name:str) -> Dict[str, Any]:
+    return analyze_function(_pool_contract, canonical_name)
+
+
+# results are yielded in the order of the functions (whatever order the workers finish in), each as soon as it is ready
+def iter_analyze_functions(fcontract:FContract, functions) -> Iterator[Dict[str, Any]]:
+    names = [func.canonical_name for func in functions]
+    if config.jobs <= 1 or len(names) <= 1:
+        for name in names:
+            yield analyze_function(fcontract, name)
+        return
+    global _pool_contract
+    _pool_contract = fcontract
+    try:
+        with ProcessPoolExecutor(max_workers=min(config.jobs, len(names)), mp_context=multiprocessing.get_context("fork")) as executor:
+            yield from executor.map(_analyze_in_worker, names)
+    finally:
+        _pool_contract = None
+
+
+def analyze_functions(fcontract:FContract, functions) -> List[Dict[str, Any]]:
+    return list(iter_analyze_functions(fcontract, functions))
+
+
+# print the results and stream them to the --dump file;
+# returns the classified effects of each function (see Classify.effects_document) when --effects is set
+def printResults(results:Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    effects = []
+    for result in results:
+        write_result(result)
+        if config.effects_dir and "effects" in result:
+            effects.append({"function": result["function"], "effects": result["effects"]})
+        if "error" in result:
+            print(f"Contract: [{result['contract']}], Function: <{result['function']}> failed: {result['error']}")
+            continue
+        print_formula_map(result)
+        print_highlevel_calls(result)
+    return effects
+
+
+def writeEffects(fcontract:FContract, results:List[Dict[str, Any]]):
+    if config.effects_dir:
+        path = write_effects(config.effects_dir, fcontract.main_name, results)
+        logger.info(f"effects of {fcontract.main_name} written to {path}")
+
+
 # ================================================================
 # online mode
+# the address a high-level call goes to, when it is known without executing the function:
+# a state variable getter (optionally converted, e.g. IERC20(token)) or a constant address
+def static_callee_address(fcontract:FContract, ir:HighLevelCall) -> Optional[str]:
+    dest = ir.destination
+    for node_ir in ir.node.irs:
+        if isinstance(node_ir, TypeConversion) and node_ir.lvalue == dest:
+            dest = node_ir.variable
+            break
+    if isinstance(dest, StateVariable):
+        return fcontract.online_helper.get_contract_address(dest, None, fcontract.address)
+    if isinstance(dest, Constant) and isinstance(dest.value, int) and 0 < dest.value < 2**160:
+        return Web3.to_checksum_address(dest.value.to_bytes(20, "big"))
+    return None
+
+
+# download and compile the statically known callees of fcontract before its functions are analyzed,
+# so that handleCallIR finds them in cached_contracts
+async def prefetch_callees(fcontract:FContract):
+    helper = fcontract.online_helper
+    addresses = []
+    for func in fcontract.sli_contract.functions:
+        for _, ir in func.all_high_level_calls():
+            if isinstance(ir, LibraryCall):
+                continue
+            try:
+                addresses.append(static_callee_address(fcontract, ir))
+            except Exception as e:
+                logger.warning(f"Failed to resolve the callee of {ir}: {e}")
+    addresses = [addr for addr in dict.fromkeys(addresses) if addr and addr not in helper.cached_contracts]
+    if not addresses:
+        return
+
+    downloads = asyncio.Semaphore(config.prefetch_concurrency)
+    # each compilation runs its own solc binary, so contracts of different versions compile concurrently
+    compilations = asyncio.Semaphore(config.prefetch_concurrency)
+
+    async def fetch(addr:str):
+        async with downloads:
+            callee_info = await asyncio.to_thread(helper.get_contract_sourcecode, addr)
+        if not callee_info or "contract_name" not in callee_info:
+            return
+        async with compilations:
+            sli_contract = await asyncio.to_thread(helper.get_slither_contract, callee_info)
+        if sli_contract is None:
+            return
+        callee_contract = await asyncio.to_thread(FContract, sli_contract=sli_contract, path=callee_info.get("contract_file", ""), name=callee_info["contract_name"], online_helper=helper, address=addr)
+        helper.cached_contracts.setdefault(addr, callee_contract)
+
+    logger.debug(f"prefetching {len(addresses)} callees of {fcontract.main_name}")
+    results = await asyncio.gather(*(fetch(addr) for addr in addresses), return_exceptions=True)
+    for addr, result in zip(addresses, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to prefetch the callee at {addr}: {result}")
+
+
+# compile the contract at addr (with its statically known callees) and register it in the helper
+def load_online_contract(onlineHelper:OnlineHelper, addr:str) -> FContract:
+    if addr in onlineHelper.cached_contracts:
+        return onlineHelper.cached_contracts[addr]
+    config_info = onlineHelper.get_contract_sourcecode(addr)
+    if not config_info:
+        raise ValueError(f"no source code for {addr}")
+    sli_contract = onlineHelper.get_slither_contract(config_info)
+    if sli_contract is None:
+        raise ValueError(f"failed to compile {config_info['contract_name']} at {addr}")
+    fcontract = FContract(sli_contract=sli_contract, path=config_info["contract_file"], name=config_info["contract_name"], online_helper=onlineHelper, address=addr)
+    fcontract.online_helper.cached_contracts[addr] = fcontract
+    if config.prefetch_callees:
+        asyncio.run(prefetch_callees(fcontract))
+    return fcontract
+
+
 def OnlineBuild(contract_info):
-    onlineHelper = OnlineHelper(contract_info["chain"], contract_info["block"])
+    onlineHelper = get_helper(contract_info["chain"], contract_info["block"])
     w3 = Web3()
     for addr in contract_info["addresses"]:
         addr = w3.to_checksum_address(addr)
         logger.debug(f"Building formula for contract at address {addr}")
-        config_info = onlineHelper.get_contract_sourcecode(addr)
-        sli_contract = onlineHelper.get_slither_contract(config_info)
-        fcontract = FContract(sli_contract=sli_contract, path=config_info["contract_file"], name=config_info["contract_name"], online_helper=onlineHelper, address=addr)
-        fcontract.online_helper.cached_contracts[addr] = fcontract
-        for func in fcontract.sli_contract.functions:
-            ffunc = FFunction(func, fcontract)
-            logger.debug(f"[F] function name:  {ffunc.func.canonical_name}")
-            # PancakeRouter.addLiquidityETH(address,uint256,uint256,uint256,address,uint256)
-            # PancakeRouter.addLiquidity(address,address,uint256,uint256,uint256,uint256,address,uint256)
-            # if ffunc.func.canonical_name == "AEST.addInitLiquidity(uint256)":
-            #     print(ffunc)
-            #     ffunc.buildCFG()
-                
+        try:
+            fcontract = load_online_contract(onlineHelper, addr)
+        except Exception as e:
+            logger.error(f"Failed to build contract at {addr}: {e}")
+            continue
+        # PancakeRouter.addLiquidityETH(address,uint256,uint256,uint256,address,uint256)
+        # PancakeRouter.addLiquidity(address,address,uint256,uint256,uint256,uint256,address,uint256)
+        writeEffects(fcontract, printResults(iter_analyze_functions(fcontract, selected_functions(fcontract))))
 
 
 # TODO: uncompleted
@@ -79,19 +227,12 @@ def OnlineBuild(contract_info):
 def BuildFormula(contract_pairs):
     for path, main_name in contract_pairs:
         logger.debug(f"Building formula for contract {main_name} at path {path}")
-        slither = Slither(path)
+        slither = load_slither(path)
         sli_contract = slither.get_contract_from_name(main_name)[0]
         fcontract = FContract(sli_contract, path, main_name)
-        for func in fcontract.sli_contract.functions:
-            # only care about public/external functions
-            ffunc = FFunction(func, fcontract)
-            # logger.debug(f"[F] function name:  {ffunc.func.canonical_name}")
-            # IF branch test: AEST._transfer(address,address,uint256)
-            # ERC20._transfer(address,address,uint256)
-            # AEST.conTest()
-            # AEST.loopTest()
-            # AEST.addInitLiquidity(uint256)
-            if ffunc.func.canonical_name == "AEST._transfer(address,address,uint256)":
-                print(ffunc)
-                ffunc.buildCFG()
-                ffunc.printFFormulaMap()
\ No newline at end of file
+        # IF branch test: AEST._transfer(address,address,uint256)
+        # ERC20._transfer(address,address,uint256)
+        # AEST.conTest()
+        # AEST.loopTest()
+        # AEST.addInitLiquidity(uint256)
+        writeEffects(fcontract, printResults(iter_analyze_functions(fcontract, selected_functions(fcontract))))
@@ -1,6 +1,7 @@
+from collections import OrderedDict
 from loguru import logger
 from z3 import *
-from typing import NamedTuple, List, Any, Union, Optional
+from typing import NamedTuple, List, Any, Union, Optional, Tuple, Dict
 from slither.core.variables import StateVariable, Variable
 from slither.slithir.operations import BinaryType
 from slither.core.solidity_types import (
@@ -20,41 +21,216 @@ class FStateVar(NamedTuple):
     stateVar: Variable
 
 
+# expressions of a variable: insertion-ordered, without duplicates.
+# entries are keyed by the AST ids of their terms, which Z3 hash-conses, so membership and union are O(1) per entry
+# and never build z3 equalities; the entries keep their terms alive, so the ids stay valid
+class ExprSet:
+    __slots__ = ("items",)
+
+    def __init__(self, entries=()):
+        self.items: Dict[Tuple, ExpressionWithConstraint] = {}
+        self.extend(entries)
+
+
+    @staticmethod
+    def key(entry) -> Tuple:
+        return tuple(term.get_id() if is_ast(term) else term for term in entry)
+
+
+    def append(self, entry):
+        if not isinstance(entry, ExpressionWithConstraint):
+            entry = ExpressionWithConstraint(*entry)
+        self.items.setdefault(self.key(entry), entry)
+
+
+    def extend(self, entries):
+        if isinstance(entries, ExprSet):
+            for key, entry in entries.items.items():
+                self.items.setdefault(key, entry)
+            return
+        for entry in entries:
+            self.append(entry)
+
+
+    def discard(self, entry):
+        self.items.pop(self.key(entry), None)
+
+
+    def copy(self) -> "ExprSet":
+        new_set = ExprSet()
+        new_set.items = self.items.copy()
+        return new_set
+
+
+    def __ior__(self, entries) -> "ExprSet":
+        self.extend(entries)
+        return self
+
+
+    def __contains__(self, entry) -> bool:
+        return self.key(entry) in self.items
+
+
+    def __iter__(self):
+        return iter(self.items.values())
+
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+    def __getitem__(self, idx):
+        if isinstance(idx, int) and idx == 0:
+            return next(iter(self.items.values()))
+        return list(self.items.values())[idx]
+
+
+    # the same entries, in any order
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ExprSet):
+            return NotImplemented
+        return self.items.keys() == other.items.keys()
+
+    __hash__ = None
+
+
+    def __repr__(self):
+        return f"ExprSet({list(self.items.values())})"
+
+
 class FFormula:
+    __slots__ = ("stateVar", "parent_contract", "parent_function", "_expressions", "approximated")
+
     def __init__(self, stateVar:FStateVar, contract=None, func=None):
         self.stateVar = stateVar
         self.parent_contract = contract
         self.parent_function = func
-        self.expressions_with_constraints : List[ExpressionWithConstraint] = []
+        self._expressions = ExprSet()
+        # the expressions were widened (see bound), they over-approximate the values of the variable
+        self.approximated = False
+
+
+    # assigning a list (or any iterable of entries) keeps the set semantics
+    @property
+    def expressions_with_constraints(self) -> ExprSet:
+        return self._expressions
+
+
+    @expressions_with_constraints.setter
+    def expressions_with_constraints(self, entries):
+        self._expressions = entries if isinstance(entries, ExprSet) else ExprSet(entries)
+        self.bound()
+
+
+    # widen the expressions once there are more than config.max_fanout of them
+    def bound(self):
+        if config.max_fanout <= 0 or len(self._expressions) <= config.max_fanout:
+            return
+        logger.debug(f"widen {len(self._expressions)} expressions of {self.stateVar.stateVar if self.stateVar else None}")
+        self._expressions = ExprSet(Widen(list(self._expressions)))
+        self.approximated = True
 
 
     def add_expression_with_constraint(self, expression: ExprRef, constraint: ExprRef):
-        self.expressions_with_constraints.append(ExpressionWithConstraint(expression, constraint))
+        self._expressions.append(ExpressionWithConstraint(expression, constraint))
         
 
     def copy(self):
         new_formula = FFormula(self.stateVar, self.parent_contract, self.parent_function)
-        new_formula.expressions_with_constraints = [ExpressionWithConstraint(expr.expression, expr.constraint) for expr in self.expressions_with_constraints]
+        new_formula._expressions = self._expressions.copy()
+        new_formula.approximated = self.approximated
         return new_formula
     
 
     def __str__(self):
         result = "\n"
-        expr_set = set()
-        for expr, _ in self.expressions_with_constraints:
-            expr_set.add(expr)
-        for idx, expr in enumerate(list(expr_set)):
+        expr_set = dict.fromkeys(expr for expr, _ in self._expressions)
+        for idx, expr in enumerate(expr_set):
             result += f"Expression [{idx}]: {expr} \n"
         return result
     
 
     def setFormula(self):
-        return list(set(self.expressions_with_constraints))
+        return list(self._expressions)
     
 
+# memoized simplify: Z3 hash-conses terms, so equal terms share one AST id and are simplified once.
+# an entry keeps its term alive, so its id cannot be reused by another term while cached;
+# results are entered as their own normal form and never simplified again
+class SimplifyCache:
+    def __init__(self, maxsize:int=config.simplify_cache_size):
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[int, Tuple[ExprRef, ExprRef]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def simplify(self, expr:ExprRef) -> ExprRef:
+        key = expr.get_id()
+        entry = self.entries.get(key)
+        if entry is not None and entry[0].eq(expr):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        result = simplify(expr)
+        self.entries[key] = (expr, result)
+        self.entries[result.get_id()] = (result, result)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return result
+
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __str__(self):
+        return f"simplify cache: {len(self.entries)} terms, {self.hits} hits, {self.misses} misses"
+
+
+simplify_cache = SimplifyCache()
+
+
 # ==============================================================================================================
 # export functions:
 
+def Simplify(expr) -> ExprRef:
+    if not is_expr(expr):
+        return simplify(expr)
+    return simplify_cache.simplify(expr)
+
+
+# one entry per sort for the given entries, that holds whenever one of them holds:
+#   ite:   If(c1, e1, If(c2, e2, ... en)), exact when the constraints are disjoint
+#   havoc: a fresh symbol, any value
+def Widen(entries:List[ExpressionWithConstraint], mode:str=None) -> List[ExpressionWithConstraint]:
+    mode = mode or config.widening
+    groups: Dict[Any, List[ExpressionWithConstraint]] = {}
+    widened = []
+    for exp, cons in entries:
+        if not is_expr(exp):
+            widened.append(ExpressionWithConstraint(exp, cons))
+            continue
+        cons = cons if is_expr(cons) else BoolVal(cons)
+        groups.setdefault(exp.sort().get_id(), []).append(ExpressionWithConstraint(exp, cons))
+    for group in groups.values():
+        if len(group) == 1:
+            widened.extend(group)
+            continue
+        constraint = Simplify(Or(*[cons for _, cons in group]))
+        if mode == "havoc":
+            expression = FreshConst(group[0].expression.sort(), "widened")
+        else:
+            expression = group[-1].expression
+            for exp, cons in reversed(group[:-1]):
+                expression = If(cons, exp, expression)
+        widened.append(ExpressionWithConstraint(expression, constraint))
+    return widened
+
+
 def Check_constraint(cons) -> bool:
     solver = Solver()
     solver.add(cons)
@@ -88,9 +264,9 @@ def Reconstruct_If(exprs_with_constraints: List[ExpressionWithConstraint]) -> Op
                 head = If(cond, expr, BoolVal(False))
             else:
                 head = If(cond, expr, head)
-        if is_false(simplify(head)):
+        if is_false(Simplify(head)):
             return Not(cond)
-        elif is_true(simplify(head)):
+        elif is_true(Simplify(head)):
             return cond
         else:
             return head
@@ -102,10 +278,53 @@ def Expand_If(expr: ExprRef, cond: ExprRef) -> List[ExpressionWithConstraint]:
     while stack:
         current_expr = stack.pop()
         if is_app_of(current_expr, Z3_OP_ITE):
-            true_expr = ExpressionWithConstraint(expression=current_expr.arg(1), constraint=simplify(And(cond, current_expr.arg(0))))
+            true_expr = ExpressionWithConstraint(expression=current_expr.arg(1), constraint=Simplify(And(cond, current_expr.arg(0))))
             expressions.append(true_expr)
             stack.append(current_expr.arg(2))
         else:
             expressions.append(ExpressionWithConstraint(expression=current_expr, constraint=cond))
     return expressions
     
+
+
+# ==================================== test ============================================
+
+def test_ExprSet():
+    x, y = Int("x"), Int("y")
+    exprs = ExprSet([ExpressionWithConstraint(x + 1, x > 0), ExpressionWithConstraint(y, BoolVal(True))])
+    # hash-consed: a rebuilt term is the same entry
+    exprs.append(ExpressionWithConstraint(x + 1, x > 0))
+    exprs |= [(y, BoolVal(True)), (x, y > 0)]
+    assert len(exprs) == 3 and (x, y > 0) in exprs and (x, y < 0) not in exprs
+    assert [str(exp) for exp, _ in exprs] == ["x + 1", "y", "x"]
+    # terms of different sorts are never compared with z3 equality
+    exprs.append((BitVec("x", 8), BoolVal(True)))
+    assert exprs.copy() == exprs and len(exprs) == 4
+    # one entry per sort
+    widened = Widen(list(exprs), "ite")
+    assert len(widened) == 2 and is_app_of(widened[0].expression, Z3_OP_ITE)
+    assert is_const(Widen(list(exprs), "havoc")[0].expression)
+    return
+
+
+def test_SimplifyCache():
+    x, y = Int("x"), Int("y")
+    cache = SimplifyCache(maxsize=4)
+    builders = [lambda: x + 0 + y, lambda: And(x > 1, x > 1), lambda: If(x > y, x, x)]
+    for build in builders:
+        miss = cache.simplify(build())
+        hits = cache.hits
+        # a rebuilt term is the same AST, so it hits and gets the very same result
+        hit = cache.simplify(build())
+        assert cache.hits == hits + 1 and hit is miss
+        assert hit.eq(simplify(build()))
+        # simplified terms are fixed points
+        assert cache.simplify(miss) is miss
+    assert len(cache.entries) <= 4
+    print(cache)
+    return
+
+
+if __name__ == "__main__":
+    test_ExprSet()
+    test_SimplifyCache()
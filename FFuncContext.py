@@ -1,5 +1,6 @@
 from typing import List, Dict, Any
 from collections import defaultdict
+from collections.abc import MutableMapping
 from slither.core.declarations import (
     Function, 
     Contract, 
@@ -16,15 +17,155 @@ from slither.slithir.operations import(
     BinaryType,
 )
 from z3 import *
-from FFormula import FFormula, ExpressionWithConstraint, Implied_exp
+from FFormula import FFormula, ExpressionWithConstraint, Implied_exp, Simplify
+
+
+_MISSING = object()
+_DELETED = object()
+
+
+class _Layer:
+    __slots__ = ("data", "parent", "depth")
+
+    def __init__(self, data:dict, parent:"_Layer"):
+        self.data = data
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent else 1
+
+
+# copy-on-write dict: copies share the frozen layers below them and only write to their own top layer
+class CowMap(MutableMapping):
+    __slots__ = ("_local", "_base")
+    # collapse the frozen layers once the chain gets this long, so lookups stay cheap
+    MAX_DEPTH = 16
+
+    def __init__(self, data:dict=None):
+        self._local = dict(data) if data else {}
+        self._base: _Layer = None
+
+
+    def _lookup(self, key):
+        value = self._local.get(key, _MISSING)
+        layer = self._base
+        while value is _MISSING and layer is not None:
+            value = layer.data.get(key, _MISSING)
+            layer = layer.parent
+        return value
+
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is _MISSING or value is _DELETED:
+            raise KeyError(key)
+        return value
+
+
+    def __setitem__(self, key, value):
+        self._local[key] = value
+
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if self._base is None:
+            del self._local[key]
+        else:
+            self._local[key] = _DELETED
+
+
+    def __contains__(self, key):
+        value = self._lookup(key)
+        return value is not _MISSING and value is not _DELETED
+
+
+    def __iter__(self):
+        return iter(self._flatten())
+
+
+    def __len__(self):
+        return len(self._flatten())
+
+
+    # written by this map since the last copy
+    def owns(self, key) -> bool:
+        value = self._local.get(key, _MISSING)
+        return value is not _MISSING and value is not _DELETED
+
+
+    def clear(self):
+        self._local = {}
+        self._base = None
+
+
+    def copy(self) -> "CowMap":
+        if self._local:
+            self._base = _Layer(self._local, self._base)
+            self._local = {}
+            if self._base.depth > self.MAX_DEPTH:
+                self._base = _Layer(self._flatten(), None)
+        new_map = CowMap()
+        new_map._base = self._base
+        return new_map
+
+
+    # the plain dict (with dict insertion order) this map stands for
+    def _flatten(self) -> dict:
+        layers = [self._local]
+        layer = self._base
+        while layer is not None:
+            layers.append(layer.data)
+            layer = layer.parent
+        result = {}
+        for data in reversed(layers):
+            for key, value in data.items():
+                if value is _DELETED:
+                    result.pop(key, None)
+                else:
+                    result[key] = value
+        return result
+
+
+# append-only list of visited nodes, copies share the common prefix
+class NodePath:
+    __slots__ = ("head", "length")
+
+    def __init__(self):
+        self.head = None
+        self.length = 0
+
+
+    def append(self, node:Node):
+        self.head = (node, self.head)
+        self.length += 1
+
+
+    def copy(self) -> "NodePath":
+        new_path = NodePath()
+        new_path.head, new_path.length = self.head, self.length
+        return new_path
+
+
+    def __iter__(self):
+        nodes = []
+        cell = self.head
+        while cell is not None:
+            nodes.append(cell[0])
+            cell = cell[1]
+        return reversed(nodes)
+
+
+    def __len__(self):
+        return self.length
 
 
 # To maintain the context of the function (call context, constraints, etc.)
 class FFuncContext:
     def __init__(self, func:Function, parent_contract:Contract, parent_func:Function=None, caller_node:Node=None, mergeFormulas:Dict[Variable, FFormula]=None, retVarMap: Dict[str, FFormula]=None):
-        self.currentFormulaMap: Dict[Variable, FFormula] = {}
+        self.currentFormulaMap: Dict[Variable, FFormula] = CowMap()
+        # formulas in currentFormulaMap created or copied by this context since the last copy()
+        self.owned = set()
         self.globalFuncConstraint = BoolVal(True)
-        self.refMap: Dict[Variable, Variable] = {}
+        self.refMap: Dict[Variable, Variable] = CowMap()
 
         self.caller_node = caller_node
         # means the rest of irs are tackling with return info, and we should delay to analyze them.
@@ -34,57 +175,78 @@ class FFuncContext:
         self.callerRetVar: Variable = None
         # name: ret_0, ret_1, ...,  ret_i (especially for TupleVariable)
         self.retVarMap: Dict[str, FFormula] = retVarMap if retVarMap is not None else {}
+        # the return values of this path only, retVarMap is shared by all the paths of the function
+        self.path_returns: Dict[str, FFormula] = CowMap()
 
         self.func = func
         self.parent_contract = parent_contract
         self.parent_func = parent_func
         # for Map and Array, ...
-        self.mapVar2Exp: Dict[Variable, ExprRef] = {}
+        self.mapVar2Exp: Dict[Variable, ExprRef] = CowMap()
         # map the params to the original args
         # e.g., from1 -> from -> account
-        self.mapIndex2Var: Dict[Variable, Variable] = {}
+        self.mapIndex2Var: Dict[Variable, Variable] = CowMap()
         # merge formulas and only single instance with no copy
         self.mergeFormulas: Dict[Variable, FFormula] = mergeFormulas if mergeFormulas is not None else {}
         # node path
-        self.node_path = []
+        self.node_path = NodePath()
         # conditional jump
         # tracing nested if-else
         self.condition_stack = []
         self.branch_cond = BoolVal(True)
+        # branch_cond before each push, so that popping does not rebuild the conjunction
+        self.branch_cond_stack = []
+        # id of the IF node visit that pushed each condition, shared by its true and false sons
+        self.fork_ids = []
+        # already merged at the current ENDIF, don't wait for siblings again
+        self.merged = False
         self.cond_expr_if = BoolVal(True)
         #  stop and give up the current path
         self.stop = False
         # loop count: Node -> int
-        self.loop_count = defaultdict(int) 
+        self.loop_count: Dict[Node, int] = CowMap()
+        # loop head -> the variables at each of its visits (see FLoop.loop_state), for --loop_summary
+        self.loop_states: Dict[Node, tuple] = CowMap()
         # potential callee contract address
-        self.temp2addrs: Dict[Variable, Variable] = {}
+        self.temp2addrs: Dict[Variable, Variable] = CowMap()
         # low-level call
         self.low_level_args: Dict[Variable, List[Variable]]= defaultdict(list)
 
     
-    def push_cond(self, conditon:ExprRef, true_or_false:bool):
+    def push_cond(self, conditon:ExprRef, true_or_false:bool, fork_id:int=None):
         actual_cond = conditon if true_or_false else Not(conditon)
         self.condition_stack.append(actual_cond)
-        self.update_branch_cond()
+        self.fork_ids.append(fork_id)
+        self.branch_cond_stack.append(self.branch_cond)
+        self.branch_cond = Simplify(And(self.branch_cond, actual_cond))
 
 
     def pop_cond(self):
         if self.condition_stack:
             self.condition_stack.pop()
-            self.update_branch_cond()
+            self.fork_ids.pop()
+            self.branch_cond = self.branch_cond_stack.pop()
 
     
-    def update_branch_cond(self):
-        if not self.condition_stack:
-            self.branch_cond = BoolVal(True)
-        else:
-            self.branch_cond = simplify(And(*self.condition_stack))
+    # what the path solver asserts for this context, outermost first
+    def path_assertions(self) -> List[ExprRef]:
+        return self.condition_stack + [self.globalFuncConstraint]
 
       
     def updateContext(self, var:Variable, fformula:FFormula):
-        # need to polish
+        fformula.bound()
         self.currentFormulaMap[var] = fformula
-        self.currentFormulaMap[var].expressions_with_constraints = list(set(self.currentFormulaMap[var].expressions_with_constraints))
+        self.owned.add(var)
+
+
+    # the formula of var that this context may modify in place, copied from the shared one on first write
+    def ownFormula(self, var:Variable) -> FFormula:
+        fformula = self.currentFormulaMap[var]
+        if var not in self.owned or not self.currentFormulaMap.owns(var):
+            fformula = fformula.copy()
+            self.currentFormulaMap[var] = fformula
+            self.owned.add(var)
+        return fformula
 
 
     def deleteContext(self, var:Variable):
@@ -95,15 +257,13 @@ class FFuncContext:
     def mergeFormula(self, var:Variable, fformula:FFormula):
         if var in self.mergeFormulas:
             for exp, cons in fformula.expressions_with_constraints:
-                self.mergeFormulas[var].expressions_with_constraints.append(ExpressionWithConstraint(exp, simplify(Implied_exp(self.globalFuncConstraint, cons))))
-            # delete redundant expressions
-            self.mergeFormulas[var].expressions_with_constraints = list(set(self.mergeFormulas[var].expressions_with_constraints))
+                self.mergeFormulas[var].expressions_with_constraints.append(ExpressionWithConstraint(exp, Simplify(Implied_exp(self.globalFuncConstraint, cons))))
         else:
             self.mergeFormulas[var] = FFormula(fformula.stateVar, fformula.parent_contract, fformula.parent_function)
             for exp, cons in fformula.expressions_with_constraints:
-                self.mergeFormulas[var].expressions_with_constraints.append(ExpressionWithConstraint(exp, simplify(Implied_exp(self.globalFuncConstraint, cons))))
-            # delete redundant expressions
-            self.mergeFormulas[var].expressions_with_constraints = list(set(self.mergeFormulas[var].expressions_with_constraints)) # type: ignore
+                self.mergeFormulas[var].expressions_with_constraints.append(ExpressionWithConstraint(exp, Simplify(Implied_exp(self.globalFuncConstraint, cons))))
+        self.mergeFormulas[var].approximated |= fformula.approximated
+        self.mergeFormulas[var].bound()
 
 
     def clearTempVariableCache(self):
@@ -123,20 +283,100 @@ class FFuncContext:
         self.refMap.clear()
 
 
+    # O(1): both contexts keep sharing the maps and copy what they modify afterwards
     def copy(self):
         new_context = FFuncContext(self.func, self.parent_contract, self.parent_func, self.caller_node, self.mergeFormulas, self.retVarMap)
-        new_context.currentFormulaMap = {var: fformula.copy() for var, fformula in self.currentFormulaMap.items()}
+        new_context.currentFormulaMap = self.currentFormulaMap.copy()
+        self.owned = set()
         new_context.returnIRs = self.returnIRs
         new_context.callerRetVar = self.callerRetVar
         new_context.globalFuncConstraint = self.globalFuncConstraint
-        new_context.refMap = {var: ref for var, ref in self.refMap.items()}
-        new_context.mapVar2Exp = {var: exp for var, exp in self.mapVar2Exp.items()}
-        new_context.mapIndex2Var = {var: index_var for var, index_var in self.mapIndex2Var.items()}
+        new_context.refMap = self.refMap.copy()
+        new_context.mapVar2Exp = self.mapVar2Exp.copy()
+        new_context.mapIndex2Var = self.mapIndex2Var.copy()
         new_context.node_path = self.node_path.copy()
         new_context.condition_stack = self.condition_stack.copy()
         new_context.branch_cond = self.branch_cond
+        new_context.branch_cond_stack = self.branch_cond_stack.copy()
+        new_context.fork_ids = self.fork_ids.copy()
         new_context.cond_expr_if = self.cond_expr_if
         new_context.loop_count = self.loop_count.copy()
-        new_context.temp2addrs = {var: addr for var, addr in self.temp2addrs.items()}
+        new_context.path_returns = self.path_returns.copy()
+        new_context.loop_states = self.loop_states.copy()
+        new_context.temp2addrs = self.temp2addrs.copy()
         return new_context
-    
+
+
+    # join the contexts of one IF that reached its ENDIF:
+    # formulas that differ between them are unioned, each entry guarded by its own branch condition
+    @staticmethod
+    def merge(contexts:List["FFuncContext"]) -> "FFuncContext":
+        merged = contexts[0].copy()
+        merged.merged = True
+        if len(contexts) == 1:
+            return merged
+        guards = [context.condition_stack[-1] for context in contexts]
+
+        variables = dict.fromkeys(var for context in contexts for var in context.currentFormulaMap.keys())
+        for var in variables:
+            formulas = [context.currentFormulaMap.get(var) for context in contexts]
+            if all(formula is not None for formula in formulas) and all(formula.expressions_with_constraints == formulas[0].expressions_with_constraints for formula in formulas[1:]):
+                continue
+            first = next(formula for formula in formulas if formula is not None)
+            fformula = FFormula(first.stateVar, first.parent_contract, first.parent_function)
+            for formula, guard in zip(formulas, guards):
+                if formula is None:
+                    continue
+                for exp, cons in formula.expressions_with_constraints:
+                    fformula.expressions_with_constraints.append(ExpressionWithConstraint(exp, Simplify(And(cons, guard))))
+                fformula.approximated |= formula.approximated
+            merged.updateContext(var, fformula)
+
+        if not all(context.globalFuncConstraint.eq(merged.globalFuncConstraint) for context in contexts[1:]):
+            merged.globalFuncConstraint = Simplify(Or(*[And(guard, context.globalFuncConstraint) for context, guard in zip(contexts, guards)]))
+        for context in contexts[1:]:
+            merged.refMap.update(context.refMap)
+            merged.mapVar2Exp.update(context.mapVar2Exp)
+            merged.mapIndex2Var.update(context.mapIndex2Var)
+            merged.temp2addrs.update(context.temp2addrs)
+            for node, count in context.loop_count.items():
+                merged.loop_count[node] = max(merged.loop_count.get(node, 0), count)
+        return merged
+
+
+# ==================================== test ============================================
+
+def test_merge():
+    x, a = Int("x"), Bool("a")
+    written, untouched = Variable(), Variable()
+    written.name, untouched.name = "x", "y"
+    root = FFuncContext(func=None, parent_contract=None)
+    for var in (written, untouched):
+        fformula = FFormula(None)
+        fformula.expressions_with_constraints = [ExpressionWithConstraint(x, BoolVal(True))]
+        root.updateContext(var, fformula)
+    # if (a) { x = x + 1; } else { x = 0; }
+    then_context, else_context = root.copy(), root.copy()
+    then_context.push_cond(a, True, fork_id=0)
+    else_context.push_cond(a, False, fork_id=0)
+    then_context.ownFormula(written).expressions_with_constraints = [ExpressionWithConstraint(x + 1, BoolVal(True))]
+    else_context.ownFormula(written).expressions_with_constraints = [ExpressionWithConstraint(IntVal(0), BoolVal(True))]
+    else_context.globalFuncConstraint = x > 0
+
+    merged = FFuncContext.merge([then_context, else_context])
+    assert merged.merged
+    entries = list(merged.currentFormulaMap[written].expressions_with_constraints)
+    assert [(str(exp), str(cons)) for exp, cons in entries] == [("x + 1", "a"), ("0", "Not(a)")]
+    # formulas that are the same on both branches are not guarded
+    assert merged.currentFormulaMap[untouched] is root.currentFormulaMap[untouched]
+    s = Solver()
+    s.add(merged.globalFuncConstraint, a, x <= 0)
+    assert s.check() == sat
+    s = Solver()
+    s.add(merged.globalFuncConstraint, Not(a), x <= 0)
+    assert s.check() == unsat
+    return
+
+
+if __name__ == "__main__":
+    test_merge()
@@ -0,0 +1,110 @@
+from typing import Callable, Dict, List, Set, Tuple
+from slither.core.variables import Variable
+from slither.slithir.variables import ReferenceVariable, TemporaryVariable
+from z3 import *
+from FFormula import ExprSet, ExpressionWithConstraint, Simplify, Widen
+from FType import FMap
+
+
+# how a variable changes over the iterations of a loop
+#   induction:   the same step every iteration (i++), i_N = i_0 + N * step
+#   accumulator: a step that depends on the iteration (sum += a[i]), sum_N = sum_0 + S, S a fresh symbol bounded by the sign of the steps
+#   widened:     anything else, a fresh symbol
+INDUCTION, ACCUMULATOR, WIDENED = "induction", "accumulator", "widened"
+
+
+# values of the variables at one visit of a loop head; temporaries and references are recomputed by the body
+LoopState = Dict[Variable, Tuple[ExpressionWithConstraint, ...]]
+
+
+def loop_state(context) -> LoopState:
+    return {
+        var: tuple(formula.expressions_with_constraints)
+        for var, formula in context.currentFormulaMap.items()
+        if not isinstance(var, (TemporaryVariable, ReferenceVariable))
+    }
+
+
+class LoopSummary:
+    def __init__(self, counter:ExprRef):
+        # number of iterations
+        self.counter = counter
+        self.values: Dict[Variable, List[ExpressionWithConstraint]] = {}
+        self.kinds: Dict[Variable, str] = {}
+
+
+    # induction values are exact only if the caller pins the counter to the first iteration failing the loop condition
+    @property
+    def approximated(self) -> Set[Variable]:
+        return {var for var, kind in self.kinds.items() if kind != INDUCTION}
+
+
+    def __str__(self):
+        kinds = ", ".join(f"{var.name}: {kind}" for var, kind in self.kinds.items())
+        return f"loop summary over {self.counter} iterations: {kinds}"
+
+
+# the values at the exit of a loop from the states of its first visits (states[0] before any iteration);
+# valid(claim) tells whether claim holds on the current path
+def summarize_loop(states:List[LoopState], counter:ExprRef, valid:Callable[[ExprRef], bool]) -> LoopSummary:
+    summary = LoopSummary(counter)
+    for var, last in states[-1].items():
+        values = [state.get(var) for state in states]
+        # declared in the body
+        if any(value is None for value in values):
+            continue
+        if all(ExprSet(value) == ExprSet(last) for value in values):
+            continue
+        exps = [value[0].expression for value in values]
+        if isinstance(var, FMap) or any(len(value) != 1 for value in values) or not all(is_arith(exp) for exp in exps):
+            summary.values[var] = Widen(list(last), "havoc") if len(last) > 1 else [ExpressionWithConstraint(FreshConst(last[0].expression.sort(), "widened"), last[0].constraint)]
+            summary.kinds[var] = WIDENED
+            continue
+
+        constraint = last[0].constraint
+        steps = [Simplify(after - before) for before, after in zip(exps, exps[1:])]
+        if all(step.eq(steps[0]) for step in steps):
+            summary.values[var] = [ExpressionWithConstraint(Simplify(exps[0] + counter * steps[0]), constraint)]
+            summary.kinds[var] = INDUCTION
+            continue
+        total = FreshConst(exps[0].sort(), "loop_sum")
+        if all(valid(step >= 0) for step in steps):
+            constraint = And(constraint, total >= 0)
+        elif all(valid(step <= 0) for step in steps):
+            constraint = And(constraint, total <= 0)
+        summary.values[var] = [ExpressionWithConstraint(exps[0] + total, Simplify(constraint))]
+        summary.kinds[var] = ACCUMULATOR
+    return summary
+
+
+# ==================================== test ============================================
+
+def test_summarize_loop():
+    i, n, total, amount = Int("i"), Int("n"), Int("total"), Int("amount")
+    balance = Array("balance", IntSort(), IntSort())
+    i_var, sum_var, flag_var = Variable(), Variable(), Variable()
+    i_var.name, sum_var.name, flag_var.name = "i", "total", "flag"
+    true = BoolVal(True)
+    # for (i = 0; i < n; i++) { total += balance[i]; flag = !flag; }
+    states = []
+    value_i, value_sum, value_flag = IntVal(0), total, Bool("flag")
+    for _ in range(3):
+        states.append({
+            i_var: (ExpressionWithConstraint(value_i, true),),
+            sum_var: (ExpressionWithConstraint(value_sum, true),),
+            flag_var: (ExpressionWithConstraint(value_flag, true),),
+        })
+        value_sum = Simplify(value_sum + Select(balance, value_i) + amount)
+        value_i = Simplify(value_i + 1)
+        value_flag = Simplify(Not(value_flag))
+    counter = Int("loop!0")
+    summary = summarize_loop(states, counter, lambda claim: False)
+    assert summary.kinds == {i_var: INDUCTION, sum_var: ACCUMULATOR, flag_var: WIDENED}
+    assert summary.values[i_var][0].expression.eq(counter)
+    assert summary.approximated == {sum_var, flag_var}
+    print(summary)
+    return
+
+
+if __name__ == "__main__":
+    test_summarize_loop()
@@ -0,0 +1,187 @@
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Any, Collection, Dict, List, Tuple
+from slither.core.cfg.node import Node
+import heapq
+import itertools
+import config
+
+
+# work list of (context, node) pairs waiting to be analyzed
+class WorkList(ABC):
+    def __init__(self):
+        # (ENDIF node, fork id) -> contexts waiting there for their siblings
+        self.parked: Dict[Tuple[Node, int], List[Any]] = {}
+
+
+    def park(self, node:Node, context):
+        self.parked.setdefault((node, context.fork_ids[-1]), []).append(context)
+
+
+    # parked groups that no context still in flight can join any more;
+    # decided on the groups parked before the call, a released group goes back in flight and may still join an outer one
+    def ready(self) -> List[Tuple[Node, List[Any]]]:
+        groups = []
+        for (node, fork_id), contexts in self.parked.items():
+            if any(fork_id in context.fork_ids for context, _ in self):
+                continue
+            if any(fork_id in context.fork_ids for key, others in self.parked.items() if key[1] != fork_id for context in others):
+                continue
+            groups.append((node, contexts))
+        for node, contexts in groups:
+            del self.parked[(node, contexts[0].fork_ids[-1])]
+        return groups
+
+
+    @abstractmethod
+    def append(self, item:Tuple[Any, Node]):
+        ...
+
+
+    @abstractmethod
+    def pop(self) -> Tuple[Any, Node]:
+        ...
+
+
+    @abstractmethod
+    def clear(self):
+        ...
+
+
+    @abstractmethod
+    def __len__(self):
+        ...
+
+
+    @abstractmethod
+    def __iter__(self):
+        ...
+
+
+class BFSWorkList(WorkList):
+    def __init__(self):
+        super().__init__()
+        self.items = deque()
+
+
+    def append(self, item):
+        self.items.append(item)
+
+
+    def pop(self):
+        return self.items.popleft()
+
+
+    def clear(self):
+        self.items.clear()
+
+
+    def __len__(self):
+        return len(self.items)
+
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+class DFSWorkList(BFSWorkList):
+    def pop(self):
+        return self.items.pop()
+
+
+# favors nodes from which the state variables written by the function can still be reached
+class PriorityWorkList(WorkList):
+    def __init__(self, ffunc):
+        super().__init__()
+        self.ffunc = ffunc
+        self.heap = []
+        # FIFO among equal priorities
+        self.counter = itertools.count()
+
+
+    def append(self, item):
+        _, node = item
+        heapq.heappush(self.heap, (-self.ffunc.stateWriteScore(node), next(self.counter), item))
+
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
+
+
+    def clear(self):
+        self.heap.clear()
+
+
+    def __len__(self):
+        return len(self.heap)
+
+
+    def __iter__(self):
+        return (item for _, _, item in self.heap)
+
+
+# number of state variables in `targets` written by node or any node reachable from it
+def reachable_writes(node:Node, targets:Collection, cache:Dict[Node, int]) -> int:
+    if node is None:
+        return 0
+    if node in cache:
+        return cache[node]
+    written = set()
+    visited = {node}
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        written.update(var for var in current.state_variables_written if var in targets)
+        for son in current.sons:
+            if son not in visited:
+                visited.add(son)
+                stack.append(son)
+    cache[node] = len(written)
+    return cache[node]
+
+
+SEARCH_STRATEGIES = {
+    "bfs": lambda ffunc: BFSWorkList(),
+    "dfs": lambda ffunc: DFSWorkList(),
+    "priority": lambda ffunc: PriorityWorkList(ffunc),
+}
+
+
+def make_work_list(ffunc, *items) -> WorkList:
+    work_list = SEARCH_STRATEGIES[config.search](ffunc)
+    for item in items:
+        work_list.append(item)
+    return work_list
+
+
+# ==================================== test ============================================
+
+def test_park_ready():
+    class Ctx:
+        def __init__(self, *fork_ids):
+            self.fork_ids = list(fork_ids)
+    endif_outer, endif_inner = "ENDIF outer", "ENDIF inner"
+    work_list = BFSWorkList()
+    # if (a) { if (b) {...} else {...} } else {...}: fork 1 at the outer IF, fork 2 at the inner one
+    inner_true, inner_false, outer_false = Ctx(1, 2), Ctx(1, 2), Ctx(1)
+    work_list.park(endif_inner, inner_true)
+    work_list.append((inner_false, "inner else"))
+    # the sibling of the inner branch is still in flight
+    assert work_list.ready() == []
+    work_list.pop()
+    work_list.park(endif_inner, inner_false)
+    work_list.park(endif_outer, outer_false)
+    # the outer group waits for the contexts parked at the inner ENDIF
+    assert work_list.ready() == [(endif_inner, [inner_true, inner_false])]
+    # the merged inner context (see FFunction.releaseMerged) is in flight towards the outer ENDIF
+    work_list.append((Ctx(1), endif_inner))
+    assert work_list.ready() == []
+    work_list.pop()
+    work_list.park(endif_outer, Ctx(1))
+    assert [(node, len(contexts)) for node, contexts in work_list.ready()] == [(endif_outer, 2)]
+    assert work_list.parked == {}
+    return
+
+
+if __name__ == "__main__":
+    test_park_ready()
@@ -0,0 +1,360 @@
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, Optional, Set
+from z3 import *
+from FFormula import Simplify
+import config
+
+
+# names of the uninterpreted constants occurring in expr
+def free_symbols(expr:ExprRef) -> FrozenSet[str]:
+    symbols = set()
+    visited = set()
+    stack = [expr]
+    while stack:
+        current = stack.pop()
+        if current.get_id() in visited:
+            continue
+        visited.add(current.get_id())
+        if is_const(current) and current.decl().kind() == Z3_OP_UNINTERPRETED:
+            symbols.add(current.decl().name())
+        else:
+            stack.extend(current.children())
+    return frozenset(symbols)
+
+
+class _CacheEntry:
+    __slots__ = ("expr", "symbols", "results")
+
+    def __init__(self, expr:ExprRef):
+        self.expr = expr
+        self.symbols = free_symbols(expr)
+        # the result depends on which of its symbols the solver constrains (e.g., uint256 >= 0),
+        # so keep one result per such subset
+        self.results: Dict[FrozenSet[str], CheckSatResult] = {}
+
+
+# LRU cache of satisfiability results, keyed on the structural hash of the simplified constraint
+class ConstraintCache:
+    def __init__(self, maxsize:int=config.constraint_cache_size):
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[int, _CacheEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def lookup(self, cons:ExprRef, axioms:Set[str]) -> Optional[CheckSatResult]:
+        key = cons.hash()
+        entry = self.entries.get(key)
+        # hash collision
+        if entry is None or not entry.expr.eq(cons):
+            self.misses += 1
+            return None
+        result = entry.results.get(entry.symbols & axioms)
+        if result is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+
+    def store(self, cons:ExprRef, axioms:Set[str], result:CheckSatResult):
+        key = cons.hash()
+        entry = self.entries.get(key)
+        if entry is None or not entry.expr.eq(cons):
+            entry = _CacheEntry(cons)
+            self.entries[key] = entry
+        entry.results[entry.symbols & axioms] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __str__(self):
+        return f"constraint cache: {len(self.entries)} entries, {self.hits} hits, {self.misses} misses"
+
+
+# shared by all FFunction instances of a run
+constraint_cache = ConstraintCache()
+
+
+_FLIP = {Z3_OP_LE: Z3_OP_GE, Z3_OP_GE: Z3_OP_LE, Z3_OP_LT: Z3_OP_GT, Z3_OP_GT: Z3_OP_LT, Z3_OP_EQ: Z3_OP_EQ}
+_NEGATE = {Z3_OP_LE: Z3_OP_GT, Z3_OP_GE: Z3_OP_LT, Z3_OP_LT: Z3_OP_GE, Z3_OP_GT: Z3_OP_LE, Z3_OP_EQ: Z3_OP_DISTINCT}
+
+
+# decides trivial constraints syntactically so that they never reach the solver
+class Prefilter:
+    def __init__(self):
+        self.sat = 0
+        self.unsat = 0
+        self.undecided = 0
+
+
+    # cons must be simplified
+    def decide(self, cons:ExprRef, axioms:Set[str]) -> Optional[CheckSatResult]:
+        result = self._decide(cons, axioms)
+        if result == sat:
+            self.sat += 1
+        elif result == unsat:
+            self.unsat += 1
+        else:
+            self.undecided += 1
+        return result
+
+
+    def _decide(self, cons:ExprRef, axioms:Set[str]) -> Optional[CheckSatResult]:
+        if is_true(cons):
+            return sat
+        if is_false(cons):
+            return unsat
+        conjuncts = cons.children() if is_and(cons) else [cons]
+
+        # a literal and its negation
+        positive, negative = set(), set()
+        for conjunct in conjuncts:
+            if is_not(conjunct):
+                negative.add(conjunct.arg(0).get_id())
+            else:
+                positive.add(conjunct.get_id())
+        if positive & negative:
+            return unsat
+
+        # interval bounds of Int symbols compared against constants
+        lower: Dict[str, int] = {}
+        upper: Dict[str, int] = {}
+        excluded: Dict[str, Set[int]] = {}
+        only_bounds = True
+        for conjunct in conjuncts:
+            bound = self._bound(conjunct)
+            if bound is None:
+                only_bounds = only_bounds and self._is_bool_literal(conjunct)
+                continue
+            name, op, val = bound
+            if name in axioms:
+                lower[name] = max(lower.get(name, 0), 0)
+            if op in (Z3_OP_LE, Z3_OP_EQ):
+                upper[name] = min(upper.get(name, val), val)
+            if op in (Z3_OP_GE, Z3_OP_EQ):
+                lower[name] = max(lower.get(name, val), val)
+            if op == Z3_OP_LT:
+                upper[name] = min(upper.get(name, val - 1), val - 1)
+            if op == Z3_OP_GT:
+                lower[name] = max(lower.get(name, val + 1), val + 1)
+            if op == Z3_OP_DISTINCT:
+                excluded.setdefault(name, set()).add(val)
+
+        for name in set(lower) & set(upper):
+            size = upper[name] - lower[name] + 1
+            if size <= 0:
+                return unsat
+            # every value of a small interval is excluded by a disequality
+            if size <= len(excluded.get(name, ())) and set(range(lower[name], upper[name] + 1)) <= excluded[name]:
+                return unsat
+        # only single-symbol bounds and literals left, and each symbol still has a value
+        if only_bounds:
+            return sat
+        return None
+
+
+    # (name, op, value) for `x op c` / `c op x` / `Not(...)` where x is an Int symbol
+    def _bound(self, atom:ExprRef):
+        negated = is_not(atom)
+        if negated:
+            atom = atom.arg(0)
+        if not is_app(atom) or atom.num_args() != 2 or atom.decl().kind() not in _FLIP:
+            return None
+        op = atom.decl().kind()
+        left, right = atom.arg(0), atom.arg(1)
+        if self._is_int_symbol(right) and is_int_value(left):
+            left, right = right, left
+            op = _FLIP[op]
+        if not (self._is_int_symbol(left) and is_int_value(right)):
+            return None
+        if negated:
+            op = _NEGATE[op]
+        return left.decl().name(), op, right.as_long()
+
+
+    def _is_int_symbol(self, expr:ExprRef) -> bool:
+        return is_int(expr) and is_const(expr) and expr.decl().kind() == Z3_OP_UNINTERPRETED
+
+
+    def _is_bool_literal(self, expr:ExprRef) -> bool:
+        if is_not(expr):
+            expr = expr.arg(0)
+        return is_bool(expr) and is_const(expr) and expr.decl().kind() == Z3_OP_UNINTERPRETED
+
+
+    def __str__(self):
+        return f"prefilter: {self.sat} sat, {self.unsat} unsat, {self.undecided} passed to the solver"
+
+
+prefilter = Prefilter()
+
+
+# a solver whose scopes follow the path condition of the context being checked:
+# one scope per assertion, so moving to a sibling/child path only pops and pushes the differing suffix
+class IncrementalSolver:
+    def __init__(self):
+        self.solver = Solver()
+        self.frames: List[ExprRef] = []
+        # axioms go below all scopes, so they are added on the next sync
+        self.pending_axioms: List[ExprRef] = []
+        self.pushes = 0
+        self.pops = 0
+
+
+    def add_axiom(self, axiom:ExprRef):
+        self.pending_axioms.append(axiom)
+
+
+    def sync(self, assertions:List[ExprRef]):
+        if self.pending_axioms:
+            self._pop_to(0)
+            self.solver.add(*self.pending_axioms)
+            self.pending_axioms = []
+        common = 0
+        for asserted, wanted in zip(self.frames, assertions):
+            if not asserted.eq(wanted):
+                break
+            common += 1
+        self._pop_to(common)
+        for assertion in assertions[common:]:
+            self.solver.push()
+            self.solver.add(assertion)
+            self.frames.append(assertion)
+            self.pushes += 1
+
+
+    def check(self, assertions:List[ExprRef], extra:ExprRef=None) -> CheckSatResult:
+        if extra is not None:
+            extra = Simplify(extra if is_expr(extra) else BoolVal(extra))
+            if is_false(extra):
+                return unsat
+            if is_true(extra):
+                extra = None
+        self.sync(assertions)
+        if extra is None:
+            return self.solver.check()
+        self.solver.push()
+        self.solver.add(extra)
+        result = self.solver.check()
+        self.solver.pop()
+        return result
+
+
+    def _pop_to(self, depth:int):
+        if len(self.frames) > depth:
+            self.solver.pop(len(self.frames) - depth)
+            self.pops += len(self.frames) - depth
+            del self.frames[depth:]
+
+
+    def __str__(self):
+        return f"incremental solver: {self.pushes} pushes, {self.pops} pops, depth {len(self.frames)}"
+
+
+# ==============================================================================================================
+# export functions:
+
+# axioms: symbols the solver has been told are non-negative (see FFunction.assignSymbolicVal)
+def Check(solver:Solver, cons, axioms:Set[str]) -> CheckSatResult:
+    if not is_expr(cons):
+        cons = BoolVal(cons)
+    cons = Simplify(cons)
+    result = prefilter.decide(cons, axioms)
+    if result is not None:
+        return result
+    result = constraint_cache.lookup(cons, axioms)
+    if result is not None:
+        return result
+    solver.push()
+    solver.add(cons)
+    result = solver.check()
+    solver.pop()
+    if result != unknown:
+        constraint_cache.store(cons, axioms, result)
+    return result
+
+
+# ==================================== test ============================================
+
+def test_ConstraintCache():
+    x, y = Int("x"), Int("y")
+    cons = Simplify(x + y < 0)
+    cache = ConstraintCache(maxsize=2)
+    cache.store(cons, set(), sat)
+    assert cache.lookup(cons, set()) == sat
+    # axioms on symbols of cons change the result, others do not
+    assert cache.lookup(cons, {"z"}) == sat
+    assert cache.lookup(cons, {"x", "y"}) is None
+    cache.store(cons, {"x", "y", "z"}, unsat)
+    assert cache.lookup(cons, {"x", "y"}) == unsat
+    assert cache.lookup(cons, set()) == sat
+    # least recently used entries are evicted
+    cache.store(Simplify(x > 1), set(), sat)
+    cache.lookup(cons, set())
+    cache.store(Simplify(y > 1), set(), sat)
+    assert cache.lookup(Simplify(x > 1), set()) is None
+    assert cache.lookup(cons, set()) == sat
+    print(cache)
+    return
+
+
+def test_Prefilter():
+    x, y = Int("x"), Int("y")
+    p = Bool("p")
+    cases = [
+        (And(x > 1, x < 3), set()),
+        (And(x > 1, x < 2), set()),
+        (x < 0, set()),
+        (x < 0, {"x"}),
+        (And(x >= 0, x <= 1, x != 0, x != 1), set()),
+        (And(p, Not(p)), set()),
+        (And(p, x == 3, y != 2), set()),
+        (And(x > 1, x * x < y), set()),
+    ]
+    for cons, axioms in cases:
+        cons = Simplify(cons)
+        result = Prefilter().decide(cons, axioms)
+        solver = Solver()
+        solver.add(*[Int(name) >= 0 for name in axioms])
+        solver.add(cons)
+        assert result is None or result == solver.check(), cons
+    assert Prefilter().decide(Simplify(And(x > 1, x < 2)), set()) == unsat
+    assert Prefilter().decide(Simplify(x < 0), {"x"}) == unsat
+    assert Prefilter().decide(Simplify(And(x > 1, x * x < y)), set()) is None
+    return
+
+
+def test_IncrementalSolver():
+    x, y = Int("x"), Int("y")
+    solver = IncrementalSolver()
+    assert solver.check([x > 0, y > x]) == sat
+    assert solver.pushes == 2
+    # sibling path: only the differing suffix is popped and pushed
+    assert solver.check([x > 0, y < 0], y > 0) == unsat
+    assert (solver.pushes, solver.pops) == (3, 1)
+    assert solver.solver.num_scopes() == 2
+    # the extra constraint does not stay on the stack
+    assert solver.check([x > 0, y < 0]) == sat
+    # an axiom goes below all scopes and survives popping them
+    solver.add_axiom(y >= 0)
+    assert solver.check([x > 0, y < 0]) == unsat
+    assert solver.check([]) == sat
+    assert solver.check([y < 0]) == unsat
+    assert [frame.eq(y < 0) for frame in solver.frames] == [True]
+    print(solver)
+    return
+
+
+if __name__ == "__main__":
+    test_ConstraintCache()
+    test_Prefilter()
+    test_IncrementalSolver()
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from loguru import logger
+from slither.core.declarations import Function, Modifier
+from slither.core.solidity_types import MappingType
+from slither.core.variables import StateVariable, Variable
+from z3 import *
+from FFormula import FFormula, FStateVar, ExpressionWithConstraint
+from FFuncContext import FFuncContext
+from FType import FMap
+import config
+
+
+# a callee analyzed once with symbolic parameters
+class FSummary:
+    def __init__(self, func:Function):
+        self.func = func
+        # (param, placeholder symbol), in order of func.parameters
+        self.params: List[Tuple[Variable, ExprRef]] = []
+        # one entry per completed path: (path constraint, ret_i -> return expressions)
+        self.paths: List[Tuple[ExprRef, Dict[str, List[ExpressionWithConstraint]]]] = []
+        # state variables/map cells at the end of the callee, in terms of the placeholders
+        self.effects: Dict[Variable, List[ExpressionWithConstraint]] = {}
+        # map cell -> the term it was read as before the callee changed it
+        self.cells: Dict[FMap, List[ExprRef]] = {}
+        # non-mapping state variables the callee reads
+        self.reads: List[StateVariable] = []
+
+
+    def __str__(self):
+        return f"Summary of <{self.func.canonical_name}>: {len(self.paths)} paths, {len(self.effects)} effects"
+
+
+# (contract, function) -> summary (None: not summarizable), least recently used first, at most config.summary_cache_size;
+# keyed on the objects since contracts of different addresses share canonical names
+summaries: "OrderedDict[Tuple[Any, Function], Optional[FSummary]]" = OrderedDict()
+_in_progress = set()
+
+
+def summarizable(func:Function) -> bool:
+    if isinstance(func, Modifier) or func.is_constructor or not func.entry_point:
+        return False
+    # the callee of an external call depends on the chain state at the call site
+    return not func.all_high_level_calls() and not func.all_low_level_calls()
+
+
+def get_summary(func:Function, contract) -> Optional[FSummary]:
+    key = (contract, func)
+    if key in summaries:
+        summaries.move_to_end(key)
+        return summaries[key]
+    # recursion, analyze the inner call inline
+    if key in _in_progress:
+        return None
+    summary = None
+    if summarizable(func):
+        _in_progress.add(key)
+        try:
+            summary = build_summary(func, contract)
+        except Exception as e:
+            logger.warning(f"Failed to summarize {func.canonical_name}: {e}")
+        finally:
+            _in_progress.discard(key)
+    summaries[key] = summary
+    while len(summaries) > config.summary_cache_size:
+        summaries.popitem(last=False)
+    logger.debug(f"[SUM] {summary if summary else f'no summary for <{func.canonical_name}>'}")
+    return summary
+
+
+# the summaries of a contract evicted from Helper.contract_cache, which would keep it alive
+def drop_summaries(contract):
+    for key in [key for key in summaries if key[0] is contract]:
+        del summaries[key]
+
+
+def build_summary(func:Function, contract) -> Optional[FSummary]:
+    from Function import FFunction
+    ffunc = FFunction(func, contract)
+    ffunc.summary_run = True
+    summary = FSummary(func)
+    context = FFuncContext(func=func, parent_contract=contract)
+    for param in func.parameters:
+        placeholder = ffunc.assignSymbolicVal(param, f"{param.name}@{func.canonical_name}")
+        fformula = FFormula(FStateVar(contract, param), contract, ffunc)
+        fformula.expressions_with_constraints = [ExpressionWithConstraint(placeholder, BoolVal(True))]
+        context.updateContext(param, fformula)
+        summary.params.append((param, placeholder))
+
+    ffunc.explore(context)
+    if ffunc.truncated:
+        return None
+
+    summary.paths = ffunc.summary_paths
+    summary.effects = {stateVar.stateVar: list(fformula.expressions_with_constraints) for stateVar, fformula in ffunc.FormulaMap.items()}
+    summary.cells = ffunc.cell_terms
+    summary.reads = [var for var in func.all_state_variables_read() if not isinstance(var.type, MappingType)]
+    return summary
+
+
+# rename the map indexes of a callee cell to the caller's variables
+def translate_var(var:Variable, index_map:Dict[Variable, Variable]) -> Variable:
+    if isinstance(var, FMap):
+        return FMap(translate_var(var.map, index_map), index_map.get(var.index, var.index), var.type)
+    return var
@@ -1,4 +1,4 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 from loguru import logger
 from slither.core.declarations import (
     Function, 
@@ -45,9 +45,15 @@ from slither.slithir.operations import(
     Length,
 )
 from z3 import *
-from FFormula import FFormula, FStateVar, ExpressionWithConstraint, Reconstruct_If
+from z3.z3util import get_vars
+import itertools
+from FFormula import FFormula, FStateVar, ExpressionWithConstraint, ExprSet, Reconstruct_If, Simplify, Widen, simplify_cache
 from FType import FMap, FTuple, BINARY_OP
 from FFuncContext import FFuncContext 
+from FSolver import Check, IncrementalSolver, constraint_cache, prefilter
+from FScheduler import make_work_list, reachable_writes
+from FSummary import FSummary, get_summary, translate_var
+from FLoop import loop_state, summarize_loop
 import config
 
 
@@ -62,26 +68,39 @@ class FFunction:
         self.FormulaMap:Dict[FStateVar, FFormula] = {}
         self.WaitCall = False
         self.solver = Solver()
+        # symbols asserted to be non-negative in self.solver
+        self.nonneg_symbols = set()
+        # path feasibility checks in incremental mode
+        self.path_solver = IncrementalSolver()
+        # for the priority search: node -> number of stateVarWrite reachable from it
+        self.write_scores = {}
+        # completed/abandoned paths of this function, bounded by config.max_paths
+        self.explored_paths = 0
+        self.truncated = False
+        # ids of IF node visits, to find the contexts to merge at ENDIF
+        self.fork_counter = itertools.count()
+        # analyzing this function as a callee summary (see FSummary)
+        self.summary_run = False
+        self.summary_paths = []
+        self.cell_terms = {}
 
     
     def Check_constraint(self, cons:ExprRef) -> bool:
-        self.solver.push()
-        self.solver.add(cons)
-        res = self.solver.check()
-        self.solver.pop()
-        return res == sat
+        return Check(self.solver, cons, self.nonneg_symbols) == sat
+
+
+    # is the path of context (plus cons) feasible
+    def Check_path(self, context:FFuncContext, cons:ExprRef=None) -> bool:
+        if config.incremental:
+            return self.path_solver.check(context.path_assertions(), cons) == sat
+        path_cons = And(context.globalFuncConstraint, context.branch_cond)
+        return self.Check_constraint(path_cons if cons is None else And(cons, path_cons))
     
 
     def Implied_exp(self, expr1, expr2):
         if config.refined:
-            self.solver.push()
-            self.solver.add(And(expr1, Not(expr2)))
-            res_1 = self.solver.check() == unsat
-            self.solver.pop()
-            self.solver.push()
-            self.solver.add(And(expr2, Not(expr1)))
-            res_2 = self.solver.check() == unsat
-            self.solver.pop()
+            res_1 = Check(self.solver, And(expr1, Not(expr2)), self.nonneg_symbols) == unsat
+            res_2 = Check(self.solver, And(expr2, Not(expr1)), self.nonneg_symbols) == unsat
             if res_1:
                 return expr1
             elif res_2:
@@ -96,25 +115,63 @@ class FFunction:
         if stateVar in self.FormulaMap:
             if repeat:
                 for exp, cons in fformula.expressions_with_constraints:
-                    self.FormulaMap[stateVar].expressions_with_constraints.append(ExpressionWithConstraint(exp, simplify(self.Implied_exp(context.globalFuncConstraint, cons))))
-                    # delete redundant expressions
-                    self.FormulaMap[stateVar].expressions_with_constraints = list(set(self.FormulaMap[stateVar].expressions_with_constraints))
+                    self.FormulaMap[stateVar].expressions_with_constraints.append(ExpressionWithConstraint(exp, Simplify(self.Implied_exp(context.globalFuncConstraint, cons))))
             else:
-                self.FormulaMap[stateVar].expressions_with_constraints.extend(fformula.expressions_with_constraints)
+                self.FormulaMap[stateVar].expressions_with_constraints |= fformula.expressions_with_constraints
+            self.FormulaMap[stateVar].approximated |= fformula.approximated
+            self.FormulaMap[stateVar].bound()
         else:
             if repeat:
                 self.FormulaMap[stateVar] = FFormula(stateVar, fformula.parent_contract, fformula.parent_function)
                 for exp, cons in fformula.expressions_with_constraints:
-                    self.FormulaMap[stateVar].expressions_with_constraints.append(ExpressionWithConstraint(exp, simplify(self.Implied_exp(context.globalFuncConstraint, cons))))
-                # delete redundant expressions
-                self.FormulaMap[stateVar].expressions_with_constraints = list(set(self.FormulaMap[stateVar].expressions_with_constraints))
+                    self.FormulaMap[stateVar].expressions_with_constraints.append(ExpressionWithConstraint(exp, Simplify(self.Implied_exp(context.globalFuncConstraint, cons))))
+                self.FormulaMap[stateVar].approximated = fformula.approximated
             else:
-                self.FormulaMap[stateVar] = fformula
+                # the formula may still be shared with sibling contexts, FormulaMap entries are changed in place
+                self.FormulaMap[stateVar] = fformula.copy()
 
 
     def printFFormulaMap(self, context:FFuncContext):
-        print(f"Contract: [{self.parent_contract.main_name}], Function: <{self.func.canonical_name}>")
-
+        print_formula_map(self.serializeFFormulaMap(context))
+
+
+    # plain (picklable) form of the results, the index of map variables rendered with their expressions in context;
+    # "smt2" holds each (expression, constraint) in SMT-LIB2 over the symbols declared in "declarations"
+    def serializeFFormulaMap(self, context:FFuncContext) -> Dict[str, Any]:
+        formulas = []
+        symbols = {}
+        for name, indexes, fformula in self.formatFFormulaMap(context):
+            entries = list(fformula.expressions_with_constraints)
+            approximated = fformula.approximated
+            for exp in itertools.chain(indexes, (term for entry in entries for term in entry)):
+                if not is_expr(exp):
+                    continue
+                for symbol in get_vars(exp):
+                    symbols[symbol.decl().name()] = symbol.decl()
+                    # computed from a value widened to a fresh symbol, or from a loop accumulator
+                    approximated |= symbol.decl().name().startswith(("widened!", "loop_sum!"))
+            formulas.append({
+                "stateVar": name + "".join(f"[{index}]" for index in indexes),
+                "var": name,
+                "index": [index.sexpr() if is_expr(index) else index for index in indexes],
+                "expressions": list(dict.fromkeys(str(exp) for exp, _ in entries)),
+                "smt2": [{"expression": as_expr(exp).sexpr(), "constraint": as_expr(cons).sexpr()} for exp, cons in entries],
+                "approximated": approximated,
+            })
+        return {
+            "contract": self.parent_contract.main_name,
+            "function": self.func.canonical_name,
+            "truncated": self.truncated,
+            "declarations": [symbols[name].sexpr() for name in sorted(symbols)],
+            "formulas": formulas,
+            "highlevel_calls": [call.function.canonical_name for _, call in self.highlevelCalls],
+        }
+
+
+    # (variable name, indexes, formula) of the state variables in FormulaMap, printed as name[index]...;
+    # an index is the expression of the map key in context, or the name of the key variable
+    def formatFFormulaMap(self, context:FFuncContext) -> List[Tuple[str, List[Any], FFormula]]:
+        formatted = []
         formula_set = set()
 
         for stateVar, fformula in self.FormulaMap.items():
@@ -127,18 +184,19 @@ class FFunction:
             formula_set.add(stateVar)
                 
             var = stateVar.stateVar
+            name, indexes = split_map_var(var)
             if not isinstance(var, FMap):
-                self._log_state_var(var.name, fformula)
+                formatted.append((name, indexes, fformula))
                 continue
             
                 
             if var.index not in context.currentFormulaMap.keys():
-                self._log_state_var(var.name, fformula)
+                formatted.append((name, indexes, fformula))
                 continue
                 
             exps = context.currentFormulaMap[var.index].expressions_with_constraints
             if not exps:
-                self._log_state_var(var.name, fformula)
+                formatted.append((name, indexes, fformula))
                 continue
                 
             for exp, _ in exps:
@@ -147,17 +205,14 @@ class FFunction:
                         inner_exps = context.currentFormulaMap[var.map.index].expressions_with_constraints
                         if inner_exps:
                             for iexp, _ in inner_exps:
-                                self._log_state_var(f"{var.map.map_name}[{iexp}][{exp}]", fformula)
+                                formatted.append((name, indexes[:-2] + [iexp, exp], fformula))
                         else:
-                            self._log_state_var(f"{var.map.map_name}[{var.map.index.name}][{exp}]", fformula)
+                            formatted.append((name, indexes[:-1] + [exp], fformula))
                     else:
-                        self._log_state_var(f"{var.map.map_name}[{var.map.index.name}][{exp}]", fformula)
+                        formatted.append((name, indexes[:-1] + [exp], fformula))
                 else:
-                    self._log_state_var(f"{var.map_name}[{exp}]", fformula)
-
-
-    def _log_state_var(self, var_name: str, fformula: FFormula):
-        print(f"StateVar: {var_name}, formula: {fformula}")
+                    formatted.append((name, indexes[:-1] + [exp], fformula))
+        return formatted
 
 
     def __str__(self):
@@ -186,7 +241,7 @@ class FFunction:
         
         # true -> loop body | false -> end loop(node)
         elif node.type == NodeType.IFLOOP:
-            context.loop_count[node] += 1
+            context.loop_count[node] = context.loop_count.get(node, 0) + 1
             self.analyzeNodeIRs(node, context)
 
         elif node.type == NodeType.ENDLOOP:
@@ -200,6 +255,8 @@ class FFunction:
                         continue
                     if isinstance(var, StateVariable) or (isinstance(var, FMap) and (isinstance(var.map, StateVariable) or isinstance(var.map, FMap))):
                         self.addFFormula(FStateVar(self.parent_contract, var), formula, context, repeat=True)
+                if self.summary_run:
+                    self.recordSummaryPath(context)
 
             for var, formula in context.currentFormulaMap.items():
                 if len(formula.expressions_with_constraints) == 0:
@@ -281,7 +338,7 @@ class FFunction:
         cond = self.getRefPointsTo(ir.value, context)
         cond_expr = self.handleVariableExpr(cond, context)
         cond_expr_if = Reconstruct_If(cond_expr)
-        context.cond_expr_if = simplify(cond_expr_if)
+        context.cond_expr_if = Simplify(cond_expr_if)
         
 
     def handleUnpackIR(self, ir:Unpack, context:FFuncContext):
@@ -293,7 +350,7 @@ class FFunction:
             fformula.expressions_with_constraints = rexp
             context.updateContext(lvalue, fformula)
         else:
-            context.currentFormulaMap[lvalue].expressions_with_constraints = rexp
+            context.ownFormula(lvalue).expressions_with_constraints = rexp
         return
     
 
@@ -305,8 +362,8 @@ class FFunction:
             var = self.getRefPointsTo(var, context)
             var_exp = self.handleVariableExpr(var, context)
             context.retVarMap[ret_idx] = FFormula(FStateVar(self.parent_contract, var), self.parent_contract, self)
-            if var_exp not in context.retVarMap[ret_idx].expressions_with_constraints:
-                context.retVarMap[ret_idx].expressions_with_constraints.extend(var_exp)
+            context.retVarMap[ret_idx].expressions_with_constraints.extend(var_exp)
+            context.path_returns[ret_idx] = context.retVarMap[ret_idx]
         return
     
 
@@ -336,7 +393,7 @@ class FFunction:
                 assert bool_var in context.currentFormulaMap.keys()
                 temp_res_set = set()
                 for exp in context.currentFormulaMap[bool_var].expressions_with_constraints:
-                    temp_res = simplify(And(And(exp.expression, exp.constraint), context.globalFuncConstraint))
+                    temp_res = Simplify(And(And(exp.expression, exp.constraint), context.globalFuncConstraint))
                     if not self.Check_constraint(temp_res):
                         continue
                     temp_res_set.add(temp_res)    
@@ -346,7 +403,7 @@ class FFunction:
                 elif len(temp_res_set) == 1:
                     context.globalFuncConstraint = temp_res_set.pop()
                 else:
-                    context.globalFuncConstraint = simplify(Or(*temp_res_set))
+                    context.globalFuncConstraint = Simplify(Or(*temp_res_set))
                 # if globalFuncConstraint is still false(can be infer directly), discard the following nodes
                 if not self.Check_constraint(context.globalFuncConstraint):
                     context.stop = True
@@ -417,8 +474,12 @@ class FFunction:
                     # apply sqrt
                     for exp, cons in self.handleVariableExpr(var, context):
                         sqrt_exp = sqrt(exp)
-                        context.currentFormulaMap[temp_var].expressions_with_constraints.append(ExpressionWithConstraint(sqrt_exp, cons))
+                        context.ownFormula(temp_var).expressions_with_constraints.append(ExpressionWithConstraint(sqrt_exp, cons))
                     return
+                if config.summaries:
+                    summary = get_summary(ir.function, context.parent_contract)
+                    if summary and self.applySummary(ir, summary, context):
+                        return
                 callee_context = FFuncContext(func=ir.function, parent_contract=context.parent_contract, parent_func=context.func, caller_node=ir.node)
                 callee_func = ir.function
             if not callee_context:
@@ -426,7 +487,7 @@ class FFunction:
                 return
                 # callee_context = FFuncContext(func=ir.function, parent_contract=context.parent_contract, parent_func=context.func, caller_node=ir.node)
             # shoud AND if_cond when calling 
-            callee_context.globalFuncConstraint = simplify(self.Implied_exp(context.globalFuncConstraint, context.branch_cond))
+            callee_context.globalFuncConstraint = Simplify(self.Implied_exp(context.globalFuncConstraint, context.branch_cond))
             if not self.Check_constraint(callee_context.globalFuncConstraint):
                 context.stop = True
                 return
@@ -444,8 +505,149 @@ class FFunction:
                 context.callerRetVar = self.getRefPointsTo(ir.lvalue, context)
 
 
+    def recordSummaryPath(self, context:FFuncContext):
+        returns = {ret_idx: list(fformula.expressions_with_constraints) for ret_idx, fformula in context.path_returns.items()}
+        # the branch conditions are not part of globalFuncConstraint
+        self.summary_paths.append((Simplify(And(context.globalFuncConstraint, context.branch_cond)), returns))
+
+
+    # instantiate the callee summary at the call site instead of analyzing the callee again,
+    # returns False if the call has to be analyzed inline
+    def applySummary(self, ir:Call, summary:FSummary, context:FFuncContext) -> bool:
+        # (term in the summary, its candidates at the call site)
+        substitutions = []
+        index_map = {}
+        for arg, (param, placeholder) in zip(ir.arguments, summary.params):
+            arg = self.getRefPointsTo(arg, context)
+            index_map[param] = context.mapIndex2Var[arg] if arg in context.mapIndex2Var.keys() else arg
+            substitutions.append((placeholder, self.handleVariableExpr(arg, context)))
+        if context.stop:
+            return True
+        # pre-state the caller has already changed
+        for var in summary.reads:
+            if var in context.currentFormulaMap and len(context.currentFormulaMap[var].expressions_with_constraints) > 0:
+                substitutions.append((self.assignSymbolicVal(var), context.currentFormulaMap[var].expressions_with_constraints))
+        for cell, terms in summary.cells.items():
+            caller_cell = translate_var(cell, index_map)
+            if caller_cell in context.currentFormulaMap and len(context.currentFormulaMap[caller_cell].expressions_with_constraints) > 0:
+                # the callee would read the value from before the caller's change
+                if len(terms) != 1:
+                    logger.debug(f"[SUM] changed cell {caller_cell} read as {len(terms)} terms by {summary}, analyze inline")
+                    return False
+                substitutions.append((terms[0], context.currentFormulaMap[caller_cell].expressions_with_constraints))
+
+        instances = 1
+        for _, candidates in substitutions:
+            instances *= len(candidates)
+        if instances > config.summary_max_instances:
+            logger.debug(f"[SUM] too many instances ({instances}) of {summary}, analyze inline")
+            return False
+        bindings = []
+        for combination in itertools.product(*[candidates for _, candidates in substitutions]):
+            pairs, guards = [], [BoolVal(True)]
+            for (term, _), (exp, cons) in zip(substitutions, combination):
+                exp = self.coerceSort(exp, term.sort())
+                if exp is None:
+                    return False
+                pairs.append((term, exp))
+                guards.append(cons)
+            bindings.append((pairs, Simplify(And(*guards))))
+        # the values before the call, kept on the callee paths that don't write them
+        before = {}
+        for var in summary.effects:
+            before[var] = self.valuesBeforeCall(var, translate_var(var, index_map), summary, bindings, context)
+            if before[var] is None:
+                logger.debug(f"[SUM] no value of {var} before {summary}, analyze inline")
+                return False
+
+        logger.debug(f"[SUM] apply {summary} with {len(bindings)} instances")
+        path_constraint = Or(*[cons for cons, _ in summary.paths]) if summary.paths else BoolVal(False)
+        call_constraint = Simplify(Or(*[And(guard, self.instantiate(path_constraint, pairs)) for pairs, guard in bindings])) if bindings else BoolVal(False)
+        context.globalFuncConstraint = Simplify(self.Implied_exp(context.globalFuncConstraint, call_constraint))
+        if not self.Check_constraint(context.globalFuncConstraint):
+            context.stop = True
+            return True
+
+        # 1. return values
+        callerRetVar = self.getRefPointsTo(ir.lvalue, context) if ir.lvalue else None
+        returns = {}
+        for pairs, guard in bindings:
+            for path_cons, path_returns in summary.paths:
+                path_guard = And(guard, self.instantiate(path_cons, pairs))
+                for ret_idx, exprs in path_returns.items():
+                    for exp, cons in exprs:
+                        new_cons = Simplify(And(path_guard, self.instantiate(cons, pairs)))
+                        if not self.Check_path(context, new_cons):
+                            continue
+                        returns.setdefault(ret_idx, []).append(ExpressionWithConstraint(Simplify(self.instantiate(exp, pairs)), new_cons))
+        if isinstance(callerRetVar, TemporaryVariable):
+            fformula = FFormula(FStateVar(self.parent_contract, callerRetVar), self.parent_contract, self)
+            fformula.expressions_with_constraints = returns['ret_0'] if 'ret_0' in returns else self.handleVariableExpr(callerRetVar, context)
+            context.updateContext(callerRetVar, fformula)
+        elif isinstance(callerRetVar, TupleVariable):
+            for idx in range(len(returns.keys())):
+                ret_idx = f"ret_{idx}"
+                tuple_var = FTuple(callerRetVar, idx, callerRetVar.type[idx])
+                fformula = FFormula(FStateVar(self.parent_contract, tuple_var), self.parent_contract, self)
+                fformula.expressions_with_constraints = returns[ret_idx] if ret_idx in returns else self.handleVariableExpr(tuple_var, context)
+                context.updateContext(tuple_var, fformula)
+
+        # 2. state variables, keeping the value before the call on the callee paths that don't write them
+        for var, exprs in summary.effects.items():
+            caller_var = translate_var(var, index_map)
+            fformula = FFormula(FStateVar(self.parent_contract, caller_var), self.parent_contract, self)
+            written = []
+            for pairs, guard in bindings:
+                for exp, cons in exprs:
+                    new_cons = Simplify(And(guard, self.instantiate(cons, pairs)))
+                    if not self.Check_path(context, new_cons):
+                        continue
+                    written.append(new_cons)
+                    fformula.expressions_with_constraints.append(ExpressionWithConstraint(Simplify(self.instantiate(exp, pairs)), new_cons))
+            if len(fformula.expressions_with_constraints) == 0:
+                continue
+            unwritten = Simplify(Not(Or(*written)))
+            for exp, cons in before[var]:
+                new_cons = Simplify(And(cons if is_expr(cons) else BoolVal(cons), unwritten))
+                if self.Check_path(context, new_cons):
+                    fformula.expressions_with_constraints.append(ExpressionWithConstraint(exp, new_cons))
+            context.updateContext(caller_var, fformula)
+        return True
+
+
+    # the value of caller_var (var in the summary) at the call site, None if unknown
+    def valuesBeforeCall(self, var:Variable, caller_var:Variable, summary:FSummary, bindings, context:FFuncContext) -> Optional[List[ExpressionWithConstraint]]:
+        if caller_var in context.currentFormulaMap and len(context.currentFormulaMap[caller_var].expressions_with_constraints) > 0:
+            return list(context.currentFormulaMap[caller_var].expressions_with_constraints)
+        if isinstance(caller_var, StateVariable):
+            return [ExpressionWithConstraint(self.assignSymbolicVal(caller_var), BoolVal(True))]
+        # a map cell the caller has not touched: the term the callee read it as
+        terms = summary.cells.get(var, [])
+        if len(terms) == 1:
+            return [ExpressionWithConstraint(Simplify(self.instantiate(terms[0], pairs)), guard) for pairs, guard in bindings]
+        return None
+
+
+    def instantiate(self, exp, pairs) -> ExprRef:
+        if not is_expr(exp):
+            exp = BoolVal(exp)
+        return substitute(exp, *pairs) if pairs else exp
+
+
+    def coerceSort(self, exp, sort):
+        if not is_expr(exp):
+            return None
+        if exp.sort() == sort:
+            return exp
+        if is_int(exp) and is_bv_sort(sort):
+            return Int2BV(exp, sort.size())
+        if is_bv(exp) and sort == IntSort():
+            return BV2Int(exp)
+        return None
+
+
     def pushCallStack(self, ir:Call, func:Function, context:FFuncContext, callee_context:FFuncContext):
-        self.call_stack.append((context, [(callee_context, func.entry_point)]))
+        self.call_stack.append((context, make_work_list(self, (callee_context, func.entry_point))))
 
 
     # TODO: not good enough
@@ -467,7 +669,7 @@ class FFunction:
         rexp = self.handleVariableExpr(rvalue, context)
         try:
             if uop == UnaryType.BANG:
-                rexp = [ExpressionWithConstraint(simplify(Not(item.expression)), item.constraint) for item in rexp]
+                rexp = [ExpressionWithConstraint(Simplify(Not(item.expression)), item.constraint) for item in rexp]
         except Exception as e:
             logger.error(f"Error in handling Unary IR: {e}")
         fformula = FFormula(FStateVar(self.parent_contract, ir.lvalue), self.parent_contract, self)
@@ -514,7 +716,7 @@ class FFunction:
             fformula.expressions_with_constraints = rexp
             context.updateContext(lvalue, fformula)
         else:
-            context.currentFormulaMap[lvalue].expressions_with_constraints = rexp
+            context.ownFormula(lvalue).expressions_with_constraints = rexp
         return
     
 
@@ -581,10 +783,12 @@ class FFunction:
                         new_exprs = []
                         for idx_exp, idx_cons in idx_exprs:
                             select_exp = Select(Array(f"{var.name}", map_from, ArraySort(inner_map_from, inner_map_to)), idx_exp)
-                            if not self.Check_constraint(self.Implied_exp(context.branch_cond, self.Implied_exp(idx_cons, context.globalFuncConstraint))):
+                            if not self.Check_path(context, idx_cons):
                                 continue
                             new_exprs.append(ExpressionWithConstraint(select_exp, idx_cons))
                         fformula.expressions_with_constraints = new_exprs
+                        if self.summary_run:
+                            self.cell_terms.setdefault(first_map_var, [exp for exp, _ in new_exprs])
                     context.updateContext(first_map_var, fformula)
             else:
                 map_to = type2type.get(type_to, IntSort())
@@ -605,7 +809,7 @@ class FFunction:
                                     for var_exp, var_cons in context.currentFormulaMap[var].expressions_with_constraints:
                                         for idx_exp, idx_cons in idx_exprs:
                                             combined_cons = self.Implied_exp(context.branch_cond, self.Implied_exp(self.Implied_exp(var_cons, idx_cons), context.globalFuncConstraint))
-                                            if not self.Check_constraint(combined_cons):
+                                            if not self.Check_path(context, And(var_cons, idx_cons)):
                                                 continue
                                             select_exp = Select(var_exp, idx_exp)
                                             new_exprs.append(ExpressionWithConstraint(select_exp, combined_cons))
@@ -622,6 +826,8 @@ class FFunction:
                                     select_exp = Select(Array(f"{var.name}", map_from, map_to), idx_exp)
                                     new_exprs.append(ExpressionWithConstraint(select_exp, idx_cons))
                             fformula.expressions_with_constraints = new_exprs
+                            if self.summary_run:
+                                self.cell_terms.setdefault(map_var, [exp for exp, _ in new_exprs])
                         context.updateContext(map_var, fformula)
             return
             
@@ -632,6 +838,7 @@ class FFunction:
         result = self.getRefPointsTo(result, context)
         left, right = self.getRefPointsTo(ir.variable_left, context), self.getRefPointsTo(ir.variable_right, context)
         lexp, rexp = self.handleVariableExpr(left, context), self.handleVariableExpr(right, context)
+        lexp, rexp, widened = self.boundOperands(lexp, rexp)
         # handle operation
         merged_exprs = self.mergeExpWithConstraints(lexp, rexp, BINARY_OP[ir.type], context)
         if isinstance(result, StateVariable):
@@ -640,61 +847,106 @@ class FFunction:
             otherwise we only update the func context 
             '''
             # so update here.
-            context.currentFormulaMap[result].expressions_with_constraints = merged_exprs
+            fformula = context.ownFormula(result)
+            fformula.expressions_with_constraints = merged_exprs
+            fformula.approximated |= widened
         elif isinstance(result, TemporaryVariable):
             # new instance
             fformula = FFormula(FStateVar(self.parent_contract, result), self.parent_contract, self)
             fformula.expressions_with_constraints = merged_exprs
+            fformula.approximated |= widened
             context.updateContext(result, fformula)
         # LocalVariables/Function Parameters
         else:
             if result in context.currentFormulaMap:
-                context.currentFormulaMap[result].expressions_with_constraints = merged_exprs
+                fformula = context.ownFormula(result)
+                fformula.expressions_with_constraints = merged_exprs
+                fformula.approximated |= widened
             else:
                 logger.error(f"no such local/params variable {result.name} in context")
         return
+
+
+    # widen the larger operand (then the other) while the product of their candidates exceeds config.max_fanout
+    def boundOperands(self, lexp:List[ExpressionWithConstraint], rexp:List[ExpressionWithConstraint]) -> Tuple[List[ExpressionWithConstraint], List[ExpressionWithConstraint], bool]:
+        widened = False
+        for side in ("left", "right") if len(lexp) >= len(rexp) else ("right", "left"):
+            if config.max_fanout <= 0 or len(lexp) * len(rexp) <= config.max_fanout:
+                break
+            if side == "left" and len(lexp) > 1:
+                lexp, widened = Widen(lexp), True
+            elif side == "right" and len(rexp) > 1:
+                rexp, widened = Widen(rexp), True
+        return lexp, rexp, widened
     
 
+    # every pair of left and right candidates; the constraints of a pair are checked (syntactically, then by the cached solver)
+    # before its expression is built, and candidates sharing a constraint are checked as one group
     def mergeExpWithConstraints(self, lexp:List[ExpressionWithConstraint], rexp:List[ExpressionWithConstraint], op:Any, context:FFuncContext) -> List[ExpressionWithConstraint]:
-        res : List[ExpressionWithConstraint] = []
-        
-        for litem, ritem in zip(lexp, rexp):
-            # all possible binary op
-            l_expr, r_expr = litem.expression, ritem.expression
-            if op.__name__ == '<lambda>' and op.__code__.co_code == (lambda x, y: x % y).__code__.co_code:
-                if isinstance(l_expr, RatNumRef):
-                    l_expr = ToInt(l_expr)
-                if isinstance(r_expr, RatNumRef):
-                    r_expr = ToInt(r_expr)
-            combined_expr = simplify(op(l_expr, r_expr))
-            if combined_expr == None:
-                logger.error(f"Error in merging expressions: {l_expr} and {r_expr}")
-            combined_constraint = simplify(self.Implied_exp(litem.constraint, ritem.constraint))
-            if not self.Check_constraint(combined_constraint):
-                continue
-            res.append(ExpressionWithConstraint(combined_expr, combined_constraint))
+        res = ExprSet()
+        is_mod = op.__name__ == '<lambda>' and op.__code__.co_code == (lambda x, y: x % y).__code__.co_code
+
+        rgroups = group_by_constraint(rexp)
+        for lcons, lterms in group_by_constraint(lexp):
+            for rcons, rterms in rgroups:
+                combined_constraint = self.combineConstraints(lcons, rcons)
+                if combined_constraint is None:
+                    continue
+                for l_expr in lterms:
+                    for r_expr in rterms:
+                        if is_mod:
+                            if isinstance(l_expr, RatNumRef):
+                                l_expr = ToInt(l_expr)
+                            if isinstance(r_expr, RatNumRef):
+                                r_expr = ToInt(r_expr)
+                        combined_expr = Simplify(op(l_expr, r_expr))
+                        if combined_expr == None:
+                            logger.error(f"Error in merging expressions: {l_expr} and {r_expr}")
+                        res.append(ExpressionWithConstraint(combined_expr, combined_constraint))
         # constaints are not satisfied, discard this branch
         if len(res) == 0:
             context.stop = True
-        return res
+        return list(res)
+
+
+    # the constraint of a pair of candidates, None if it cannot hold
+    def combineConstraints(self, lcons:ExprRef, rcons:ExprRef) -> Optional[ExprRef]:
+        if is_false(lcons) or is_false(rcons):
+            return None
+        # c and Not(c)
+        if (is_not(lcons) and lcons.arg(0).eq(rcons)) or (is_not(rcons) and rcons.arg(0).eq(lcons)):
+            return None
+        if lcons.eq(rcons) or is_true(rcons):
+            combined_constraint = lcons
+        elif is_true(lcons):
+            combined_constraint = rcons
+        else:
+            combined_constraint = Simplify(self.Implied_exp(lcons, rcons))
+        if not self.Check_constraint(combined_constraint):
+            return None
+        return combined_constraint
     
 
-    def assignSymbolicVal(self, var:Variable):
+    def assignSymbolicVal(self, var:Variable, name:str=None):
         formula = None
+        name = name if name else var.name
 
         if var.type == ElementaryType("uint256"):
-            formula = Int(var.name)
-            self.solver.add(formula >= 0)
+            formula = Int(name)
+            if name not in self.nonneg_symbols:
+                self.nonneg_symbols.add(name)
+                self.solver.add(formula >= 0)
+                self.path_solver.add_axiom(formula >= 0)
         elif var.type == ElementaryType("bool"):
-            formula = Bool(var.name)
+            formula = Bool(name)
         elif var.type == ElementaryType("string"):
-            formula = String(var.name)
+            formula = String(name)
         elif var.type == ElementaryType("address"):
-            formula = BitVec(var.name, 160)
+            formula = BitVec(name, 160)
         elif var.type.storage_size[0] == 20:
-            formula = BitVec(var.name, 160)
+            formula = BitVec(name, 160)
         else:
-            formula = Int(var.name)
+            formula = Int(name)
 
         return formula
 
@@ -702,8 +954,7 @@ class FFunction:
     # TODO: SolidityVariables are not complete.
     def handleVariableExpr(self, var:Variable, context:FFuncContext) -> List[ExpressionWithConstraint]:
         expressions_with_constraints = []
-        combine_if_cons = simplify(And(context.globalFuncConstraint, context.branch_cond))
-        if not self.Check_constraint(combine_if_cons):
+        if not self.Check_path(context):
             context.stop = True
             return expressions_with_constraints
         # handle Constant
@@ -747,12 +998,11 @@ class FFunction:
                 expressions_with_constraints.append(varExpr)
             else:
                 for exp, cons in context.currentFormulaMap[var].expressions_with_constraints:
-                    temp_cons = simplify(self.Implied_exp(cons, combine_if_cons))
-                    if not self.Check_constraint(temp_cons):
+                    if not self.Check_path(context, cons):
                         continue
-                    expressions_with_constraints.append(ExpressionWithConstraint(exp, simplify(self.Implied_exp(cons, context.branch_cond))))
+                    expressions_with_constraints.append(ExpressionWithConstraint(exp, Simplify(self.Implied_exp(cons, context.branch_cond))))
 
-        return list(set(expressions_with_constraints))
+        return list(ExprSet(expressions_with_constraints))
          
 
     def getRefPointsTo(self, ref:Variable, context:FFuncContext):
@@ -839,6 +1089,10 @@ class FFunction:
             logger.debug(f"----- ir[{type(ir)}] : {ir}")
 
 
+    def stateWriteScore(self, node:Node) -> int:
+        return reachable_writes(node, self.stateVarWrite, self.write_scores)
+
+
     def printHighlevelCalls(self):
         print("Highlevel_calls: ")
         for contract, call in self.highlevelCalls:
@@ -849,22 +1103,54 @@ class FFunction:
     # reorder basic blocks(nodes) of function (especially for those have modifiers)
     # pass Context to the son nodes
     def buildCFG(self):
+        context = self.run()
+
+        self.printFFormulaMap(context)
+
+        self.printHighlevelCalls()
+
+        return
+
+
+    def run(self) -> FFuncContext:
         context = FFuncContext(func=self.func, parent_contract=self.parent_contract)
+        context = self.explore(context)
+
+        logger.debug(f"[S] {prefilter}")
+        logger.debug(f"[S] {constraint_cache}")
+        logger.debug(f"[S] {simplify_cache}")
+        if config.incremental:
+            logger.debug(f"[S] {self.path_solver}")
+
+        return context
+
+
+    # symbolically execute the function from its entry point with the given root context,
+    # returns the last analyzed context
+    def explore(self, context:FFuncContext) -> FFuncContext:
         context.node_path.append(self.func.entry_point)
         self.call_stack = []
-        work_list = [(context, self.func.entry_point)]
+        work_list = make_work_list(self, (context, self.func.entry_point))
         self.call_stack.append((False, work_list))
 
         while self.call_stack:
+            if config.max_paths and self.explored_paths >= config.max_paths:
+                logger.warning(f"Function {self.func.canonical_name} has exceeded the path budget ({config.max_paths}), the results are partial.")
+                self.truncated = True
+                break
             self.WaitCall = False
             # add a current_work_list for inter-function/inter-contract analysis
             caller_context, current_work_list = self.call_stack[-1]
+            if len(current_work_list) == 0 and current_work_list.parked:
+                self.releaseMerged(current_work_list)
             if len(current_work_list) == 0:
                 # pop stack
                 self.call_stack.pop()
                 # update caller context 
                 if caller_context:
                     flag = self.updateContext_FuncRet(caller_context, context)
+                    if len(self.call_stack) == 1 and (caller_context.stop or (not flag and self.is_terminal_node(context.caller_node))):
+                        self.explored_paths += 1
                     # multi calls in the same Node
                     if flag:
                         continue
@@ -877,16 +1163,25 @@ class FFunction:
                     context = caller_context
                 continue
 
-            context, node = current_work_list.pop(0)
+            context, node = current_work_list.pop()
             context.callflag = False
             if not node:
                 continue
+            # wait at the join point until the other branches of the same IF arrive
+            if config.merge_states and node.type == NodeType.ENDIF and context.fork_ids and context.fork_ids[-1] is not None and not context.merged:
+                current_work_list.park(node, context)
+                self.releaseMerged(current_work_list)
+                continue
             # print debug info
             self.printNodeInfo(context, node)
 
             self.analyzeNode(node, context)
 
-            if self.WaitCall or context.stop:
+            if self.WaitCall:
+                continue
+            if len(self.call_stack) == 1 and (context.stop or self.is_terminal_node(node)):
+                self.explored_paths += 1
+            if context.stop:
                 continue
 
             if node.type == NodeType.IF or node.type == NodeType.IFLOOP:
@@ -896,26 +1191,29 @@ class FFunction:
             else:
                 self.process_general_node(context, node, current_work_list)
 
-        self.printFFormulaMap(context)
-
-        self.printHighlevelCalls()
-
-        return
+        return context
     
             
+    def releaseMerged(self, work_list):
+        for node, contexts in work_list.ready():
+            logger.debug(f"[M] merge {len(contexts)} contexts at {node}")
+            work_list.append((FFuncContext.merge(contexts), node))
+
+
     def process_if_node(self, context:FFuncContext, node:Node, work_list):
         if node.type == NodeType.IF:
             true_son, false_son = node.son_true, node.son_false
             true_context, false_context = context.copy(), context.copy()
+            fork_id = next(self.fork_counter)
 
             true_context.node_path.append(true_son)
-            true_context.push_cond(context.cond_expr_if, True)
-            if self.Check_constraint(simplify(And(true_context.globalFuncConstraint, true_context.branch_cond))):
+            true_context.push_cond(context.cond_expr_if, True, fork_id)
+            if self.Check_path(true_context):
                 work_list.append((true_context, true_son))
 
             false_context.node_path.append(false_son)
-            false_context.push_cond(context.cond_expr_if, False)
-            if self.Check_constraint(simplify(And(false_context.globalFuncConstraint, false_context.branch_cond))):
+            false_context.push_cond(context.cond_expr_if, False, fork_id)
+            if self.Check_path(false_context):
                 work_list.append((false_context, false_son))
         elif node.type == NodeType.IFLOOP:
             # enter loop body
@@ -925,18 +1223,67 @@ class FFunction:
             true_context.node_path.append(true_son)
             false_context.node_path.append(false_son)
             # true_context.push_cond(context.cond_expr_if, True)
-            if context.loop_count[node] > config.max_iter:
+            if config.loop_summary:
+                true_context.loop_states[node] = context.loop_states.get(node, ()) + (loop_state(context),)
+                # a later entry into the loop starts over
+                for loop_map in (false_context.loop_count, false_context.loop_states):
+                    if node in loop_map:
+                        del loop_map[node]
+            if context.loop_count.get(node, 0) > config.max_iter:
                 work_list.append((false_context, false_son))
                 # should warning users here
                 logger.warning(f"Loop Node {node} has exceeded the maximum iteration limit ({config.max_iter}), skipping the rest of the analysis.")
             else:
-                if self.Check_constraint(simplify(And(true_context.globalFuncConstraint, context.cond_expr_if))):
-                    work_list.append((true_context, true_son))
+                if self.Check_constraint(Simplify(And(true_context.globalFuncConstraint, context.cond_expr_if))):
+                    if config.loop_summary and context.loop_count.get(node, 0) > max(2, config.loop_unroll):
+                        self.summarizeLoop(node, true_context.loop_states[node], false_context)
+                        if not false_context.stop:
+                            work_list.append((false_context, false_son))
+                    else:
+                        work_list.append((true_context, true_son))
                 else:
                     
                     work_list.append((false_context, false_son))
 
 
+    # leave the loop at node with the values of its variables after any number of iterations (see FLoop.summarize_loop),
+    # computed from the visits unrolled so far; context is the context that leaves the loop
+    def summarizeLoop(self, node:Node, states:Tuple, context:FFuncContext):
+        counter = Int(f"loop!{node.node_id}!{next(self.fork_counter)}")
+        # on this path only, the shared solver and the cached axioms stay as they are
+        context.globalFuncConstraint = Simplify(And(context.globalFuncConstraint, counter >= 0))
+        summary = summarize_loop(list(states), counter, lambda claim: not self.Check_constraint(And(context.globalFuncConstraint, Not(claim))))
+        logger.debug(f"[L] {node}: {summary}")
+        for var, entries in summary.values.items():
+            context.ownFormula(var).expressions_with_constraints = entries
+        pinned = self.exitLoop(node, counter, context)
+        # induction variables are exact only when the counter is the first iteration failing the condition
+        for var in summary.values:
+            context.currentFormulaMap[var].approximated |= var in summary.approximated or not pinned
+
+
+    # the loop condition over the summarized values is false at the exit and, unless the loop never ran, held one iteration before;
+    # returns whether the counter is pinned that way. a condition with calls is not evaluated again, and
+    # re-evaluating it may stop the path (e.g., the summarized values make it infeasible)
+    def exitLoop(self, node:Node, counter:ExprRef, context:FFuncContext) -> bool:
+        if any(isinstance(ir, Call) for ir in node.irs):
+            return False
+        self.analyzeNodeIRs(node, context)
+        if context.stop:
+            return False
+        cond = context.cond_expr_if if is_expr(context.cond_expr_if) else BoolVal(context.cond_expr_if)
+        exit_constraint = And(context.globalFuncConstraint, Not(cond))
+        # fresh symbols stand for the values after the last iteration, the condition one iteration before is unknown
+        pinned = not any(symbol.decl().name().startswith(("widened!", "loop_sum!")) for symbol in get_vars(cond))
+        if pinned:
+            exit_constraint = And(exit_constraint, Or(counter == 0, substitute(cond, (counter, counter - 1))))
+        exit_constraint = Simplify(exit_constraint)
+        if not self.Check_constraint(exit_constraint):
+            return False
+        context.globalFuncConstraint = exit_constraint
+        return pinned
+
+
     def process_general_node(self, context, node, work_list):
         if len(node.sons) == 0 and node.type in [NodeType.ENDIF, NodeType.ENDLOOP]:
             context.pop_cond()
@@ -948,4 +1295,94 @@ class FFunction:
                 new_context.pop_cond()
             work_list.append((new_context, son))
 
-            
\ No newline at end of file
+
+# (name of the underlying state variable, names of the key variables) of a possibly nested map cell
+def split_map_var(var:Variable) -> Tuple[str, List[str]]:
+    if isinstance(var, FMap):
+        name, indexes = split_map_var(var.map)
+        return name, indexes + [var.index.name]
+    return var.name, []
+
+
+# plain values stored in formulas (e.g. the True constraint of handleLengthIR) as z3 terms
+def as_expr(value) -> ExprRef:
+    if is_expr(value):
+        return value
+    if isinstance(value, bool):
+        return BoolVal(value)
+    if isinstance(value, int):
+        return IntVal(value)
+    return StringVal(str(value))
+
+
+# (constraint, expressions) of candidates, grouped by constraint in order
+def group_by_constraint(entries:List[ExpressionWithConstraint]) -> List[Tuple[ExprRef, List[ExprRef]]]:
+    groups: Dict[int, Tuple[ExprRef, List[ExprRef]]] = {}
+    for exp, cons in entries:
+        cons = cons if is_expr(cons) else BoolVal(cons)
+        groups.setdefault(cons.get_id(), (cons, []))[1].append(exp)
+    return list(groups.values())
+
+
+def print_formula_map(result:Dict[str, Any]):
+    print(f"Contract: [{result['contract']}], Function: <{result['function']}>")
+    for formula in result["formulas"]:
+        expressions = "".join(f"Expression [{idx}]: {exp} \n" for idx, exp in enumerate(formula["expressions"]))
+        approximated = " (approximated)" if formula.get("approximated") else ""
+        print(f"StateVar: {formula['stateVar']}{approximated}, formula: \n{expressions}")
+
+
+def print_highlevel_calls(result:Dict[str, Any]):
+    print("Highlevel_calls: ")
+    for name in result["highlevel_calls"]:
+        print(name)
+
+
+# ==================================== test ============================================
+
+def test_addFFormula():
+    x = Int("x")
+    var = StateVariable()
+    var.name = "x"
+    root = FFuncContext(func=None, parent_contract=None)
+    fformula = FFormula(FStateVar(None, var))
+    fformula.expressions_with_constraints = [ExpressionWithConstraint(x, BoolVal(True))]
+    root.updateContext(var, fformula)
+    # two branches writing x: the left one owns a new formula, the right one still shares the root's
+    left, right = root.copy(), root.copy()
+    left.ownFormula(var).expressions_with_constraints = [ExpressionWithConstraint(x + 1, x > 0)]
+    ffunc = FFunction.__new__(FFunction)
+    ffunc.FormulaMap = {}
+    key = FStateVar(None, var)
+    ffunc.addFFormula(key, right.currentFormulaMap[var])
+    ffunc.addFFormula(key, left.currentFormulaMap[var])
+    assert [str(exp) for exp, _ in ffunc.FormulaMap[key].expressions_with_constraints] == ["x", "x + 1"]
+    for context in (root, right):
+        assert [str(exp) for exp, _ in context.currentFormulaMap[var].expressions_with_constraints] == ["x"]
+    return
+
+
+def test_mergeExpWithConstraints():
+    x, y, a = Int("x"), Int("y"), Bool("a")
+    true = BoolVal(True)
+    entries = [ExpressionWithConstraint(x, a), ExpressionWithConstraint(y, true), ExpressionWithConstraint(x + 1, a)]
+    assert [(str(cons), [str(exp) for exp in exps]) for cons, exps in group_by_constraint(entries)] == [("a", ["x", "x + 1"]), ("True", ["y"])]
+
+    ffunc = FFunction.__new__(FFunction)
+    ffunc.solver = Solver()
+    ffunc.nonneg_symbols = set()
+    context = FFuncContext(func=None, parent_contract=None)
+    lexp = [ExpressionWithConstraint(x, a), ExpressionWithConstraint(IntVal(0), Not(a))]
+    rexp = [ExpressionWithConstraint(IntVal(1), a), ExpressionWithConstraint(y, true)]
+    merged = ffunc.mergeExpWithConstraints(lexp, rexp, lambda l, r: l + r, context)
+    # (x, a) + (1, a), (x, a) + (y, True), (0, Not(a)) + (y, True); (0, Not(a)) + (1, a) cannot hold
+    assert [(str(exp), str(cons)) for exp, cons in merged] == [("1 + x", "a"), ("x + y", "a"), ("y", "Not(a)")]
+    assert not context.stop
+    assert ffunc.mergeExpWithConstraints([ExpressionWithConstraint(x, a)], [ExpressionWithConstraint(y, Not(a))], lambda l, r: l + r, context) == []
+    assert context.stop
+    return
+
+
+if __name__ == "__main__":
+    test_addFFormula()
+    test_mergeExpWithConstraints()
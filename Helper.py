@@ -4,19 +4,73 @@ from slither.core.variables import Variable
 from slither.core.variables import (
     StateVariable,
 )
+from slither.core.declarations import Contract
+from slither.core.solidity_types import ElementaryType, UserDefinedType
+from RPC import RPCClient, http_session
+from Store import source_store
 
 from z3 import *
+from typing import Any
 from loguru import logger
-import requests
 import json
 import os
 import re
 import toml
-import pandas as pd
+import csv
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import config as settings
 
 
-selector_df = pd.read_csv('4bytes.csv', usecols=['text_signature', 'hex_signature'], dtype={'text_signature': str, 'hex_signature': str})
-selector_df = selector_df.set_index('hex_signature')
+# 4bytes.csv indexed in sqlite (built once, rebuilt when the csv is newer), opened at the first lookup of each process
+class SelectorIndex:
+    def __init__(self, csv_path:str='4bytes.csv', db_path:str='4bytes.sqlite'):
+        self.csv_path = csv_path
+        self.db_path = db_path
+        self.conn: sqlite3.Connection = None
+        # process that opened conn, as in RPC.CallCache: --jobs workers open their own after fork()
+        self.pid: int = None
+
+
+    def open(self):
+        if self.conn is not None and self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        if not os.path.exists(self.db_path) or (os.path.exists(self.csv_path) and os.path.getmtime(self.csv_path) > os.path.getmtime(self.db_path)):
+            self.build()
+        self.conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+
+
+    def build(self):
+        logger.info(f"building selector index {self.db_path} from {self.csv_path}")
+        tmp_path = f"{self.db_path}.{os.getpid()}.tmp"
+        # the temporary index only exists once the csv is open, and never outlives a failed build
+        with open(self.csv_path, 'r', encoding='utf-8', newline='') as f:
+            try:
+                conn = sqlite3.connect(tmp_path)
+                conn.execute("CREATE TABLE selectors (selector INTEGER PRIMARY KEY, text_signature TEXT NOT NULL) WITHOUT ROWID")
+                rows = ((int(row['hex_signature'], 16), row['text_signature']) for row in csv.DictReader(f) if row['hex_signature'])
+                # keep the first signature of a selector, as the csv lists them
+                conn.executemany("INSERT OR IGNORE INTO selectors VALUES (?, ?)", rows)
+                conn.commit()
+                conn.close()
+                os.replace(tmp_path, self.db_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+
+    def lookup(self, selector) -> str:
+        self.open()
+        if isinstance(selector, str):
+            selector = int(selector, 16)
+        row = self.conn.execute("SELECT text_signature FROM selectors WHERE selector = ?", (selector,)).fetchone()
+        return row[0] if row else None
+
+
+selector_index = SelectorIndex()
 
 # Load configuration
 try:
@@ -31,17 +85,141 @@ except Exception as e:
 # =================================================================
 
 
+# FContract objects of all helpers, (chain, block, address) -> FContract, least recently used evicted
+class ContractCache:
+    def __init__(self):
+        self.entries: "OrderedDict[tuple, Any]" = OrderedDict()
+        self.lock = threading.RLock()
+
+
+    def get(self, key: tuple):
+        with self.lock:
+            fcontract = self.entries.get(key)
+            if fcontract is not None:
+                self.entries.move_to_end(key)
+            return fcontract
+
+
+    def put(self, key: tuple, fcontract):
+        with self.lock:
+            self.entries[key] = fcontract
+            self.entries.move_to_end(key)
+            while len(self.entries) > settings.contract_cache_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.evicted(evicted)
+
+
+    def pop(self, key: tuple):
+        with self.lock:
+            fcontract = self.entries.pop(key)
+            self.evicted(fcontract)
+            return fcontract
+
+
+    def evicted(self, fcontract):
+        from FSummary import drop_summaries
+        drop_summaries(fcontract)
+
+
+    def keys_of(self, chain: str, block: int) -> list:
+        with self.lock:
+            return [key[2] for key in self.entries if key[0] == chain and key[1] == block]
+
+
+    # the slither contract of address compiled for any block, the source does not depend on the block
+    def compiled(self, chain: str, address: str):
+        with self.lock:
+            for (key_chain, _, key_address), fcontract in reversed(self.entries.items()):
+                if key_chain == chain and key_address == address:
+                    return fcontract.sli_contract
+        return None
+
+
+contract_cache = ContractCache()
+
+
+# the part of contract_cache of one (chain, block), what OnlineHelper.cached_contracts used to be
+class CachedContracts(MutableMapping):
+    def __init__(self, chain: str, block: int):
+        self.chain = chain
+        self.block = block
+
+
+    def __getitem__(self, address):
+        fcontract = contract_cache.get((self.chain, self.block, address))
+        if fcontract is None:
+            raise KeyError(address)
+        return fcontract
+
+
+    def __setitem__(self, address, fcontract):
+        contract_cache.put((self.chain, self.block, address), fcontract)
+
+
+    def __delitem__(self, address):
+        contract_cache.pop((self.chain, self.block, address))
+
+
+    def __contains__(self, address):
+        return contract_cache.get((self.chain, self.block, address)) is not None
+
+
+    def __iter__(self):
+        return iter(contract_cache.keys_of(self.chain, self.block))
+
+
+    def __len__(self):
+        return len(contract_cache.keys_of(self.chain, self.block))
+
+
 class OnlineHelper:
     def __init__(self, chain: str, block_number: int):
         self.chain = chain
-        self.w3 = Web3(Web3.HTTPProvider(CHAIN_INFO[chain]))
+        self.rpc = RPCClient(CHAIN_INFO[chain], chain=chain)
+        self.w3 = Web3(Web3.HTTPProvider(CHAIN_INFO[chain], session=self.rpc.session))
         self.block_number = block_number if block_number != -1 else self.get_block_number()
-        self.cached_contracts = {}
+        self.cached_contracts = CachedContracts(chain, self.block_number)
         self.var2onchain_addr = {}
+        # (contract address, getter name) -> address it returns at block_number (None: not an address)
+        self.getter_addresses = {}
 
 
     def get_block_number(self):
-        return self.w3.eth.block_number
+        return self.rpc.block_number()
+
+
+    def getter_calldata(self, name: str) -> str:
+        return "0x" + bytes(self.w3.keccak(text=f"{name}()")[:4]).hex()
+
+
+    def decode_address(self, result: bytes):
+        if result is None or len(result) < 20:
+            return None
+        address = '0x' + result[-20:].hex()
+        return self.w3.to_checksum_address(address) if self.w3.is_address(address) else None
+
+
+    # resolve every public address/contract getter of the contract in one batch, before the analysis asks for them
+    def prefetch_getters(self, sli_contract: Contract, contract_address: str):
+        if sli_contract is None:
+            return
+        contract_address = self.w3.to_checksum_address(contract_address)
+        names = []
+        for var in sli_contract.state_variables:
+            if var.visibility != "public" or (contract_address, var.name) in self.getter_addresses:
+                continue
+            if (isinstance(var.type, ElementaryType) and var.type.name.startswith("address")) or (isinstance(var.type, UserDefinedType) and isinstance(var.type.type, Contract)):
+                names.append(var.name)
+        if not names:
+            return
+        try:
+            results = self.rpc.eth_calls([(contract_address, self.getter_calldata(name)) for name in names], self.block_number)
+        except Exception as e:
+            logger.warning(f"Failed to prefetch the getters of {contract_address}: {str(e)}")
+            return
+        for name, result in zip(names, results):
+            self.getter_addresses[(contract_address, name)] = self.decode_address(result)
+        logger.debug(f"prefetched {len(names)} getters of {contract_address}, {self.rpc}")
 
 
     def get_contract_address(self, contract_var: Variable, context: FFuncContext, contract_address: str):
@@ -49,24 +227,18 @@ class OnlineHelper:
             if not contract_var.visibility != "Public":
                 return None
             contract_var_name = contract_var.name
-            function_signature = f"{contract_var_name}()"
-            function_selector = self.w3.keccak(text=function_signature)[:4].hex()
-            try:
-                result = self.w3.eth.call({
-                    'to': self.w3.to_checksum_address(contract_address),
-                    'data': function_selector,
-                }, block_identifier=self.block_number)
-
-                address = '0x' + result.hex()[-40:]
-                
-                if self.w3.is_address(address):
-                    return self.w3.to_checksum_address(address)
-                else:
-                    raise ValueError(f"Invalid address returned for {contract_var_name}")
-                    
-            except Exception as e:
-                logger.warning(f"Failed to get address for {contract_var_name}: {str(e)}")
-                return None
+            contract_address = self.w3.to_checksum_address(contract_address)
+            key = (contract_address, contract_var_name)
+            if key not in self.getter_addresses:
+                try:
+                    result = self.rpc.eth_call(contract_address, self.getter_calldata(contract_var_name), self.block_number)
+                except Exception as e:
+                    logger.warning(f"Failed to get address for {contract_var_name}: {str(e)}")
+                    return None
+                self.getter_addresses[key] = self.decode_address(result)
+            if self.getter_addresses[key] is None:
+                logger.warning(f"Failed to get address for {contract_var_name}: no address returned")
+            return self.getter_addresses[key]
             
         else:
             if contract_var in context.currentFormulaMap.keys():
@@ -86,7 +258,7 @@ class OnlineHelper:
         return None
     
     
-    def get_contract_sourcecode(self, address: str, save_dir: str = './contracts') -> dict:
+    def get_contract_sourcecode(self, address: str) -> dict:
         logger.info(f"get contract sourcecode: {address}")
         address = self.w3.to_checksum_address(address)
 
@@ -95,10 +267,11 @@ class OnlineHelper:
                 "address": address,
             }
 
-        
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
-            
+        manifest = source_store.get(self.chain, address)
+        if manifest is not None:
+            logger.debug(f"source of {address} found in the source store")
+            return source_store.contract_info(manifest)
+
         api_url = API_URLS.get(self.chain)
         api_key = API_KEYS.get(self.chain)
         
@@ -113,7 +286,7 @@ class OnlineHelper:
         }
         
         try:
-            response = requests.get(api_url, params=params)
+            response = http_session.get(api_url, params=params)
             data = response.json()
             
             if data["status"] != "1" or not data["result"]:
@@ -125,16 +298,8 @@ class OnlineHelper:
             source_code = contract_data.get("SourceCode", "")
             contract_name = contract_data.get("ContractName", "")
             compiler_version = contract_data.get("CompilerVersion", "").replace("v", "")
+            sources, compiler_settings = {f"{contract_name}.sol": source_code}, {}
 
-            if os.path.exists(os.path.join(save_dir, f"{address[2:8]}_{contract_name}.sol")):
-                result = {
-                    "address": address,
-                    "contract_name": contract_name,
-                    "compiler_version": compiler_version,
-                    "contract_file": os.path.join(save_dir, f"{address[2:8]}_{contract_name}.sol")
-                }        
-                return result
-            
             # check if it is a standard JSON input or a single file
             if source_code.startswith("{") and source_code.endswith("}"):
                 try:
@@ -142,63 +307,33 @@ class OnlineHelper:
                         source_code = source_code[1:-1]
                     
                     source_json = json.loads(source_code)
-                    
-                    if "sources" in source_json:
-                        sources = source_json["sources"]
-                        contract_dir = os.path.join(save_dir, f"{address[2:8]}")
-                        if not os.path.exists(contract_dir):
-                            os.makedirs(contract_dir)
-                        
-                        for file_path, file_info in sources.items():
-                            file_content = file_info.get("content", "")
-                            
-                            clean_path = file_path.replace("/", "_").replace(":", "_")
-                            out_path = os.path.join(contract_dir, clean_path)
-                            
-                            with open(out_path, "w", encoding="utf-8") as f:
-                                f.write(file_content)
-                            
-                            logger.info(f"save the source file: {out_path}")
-                            
-                        main_file = None
-                        for file_path in sources.keys():
-                            if contract_name in file_path or re.search(f"[^a-zA-Z0-9]{contract_name}[^a-zA-Z0-9]", file_path):
-                                main_file = file_path
-                                break
+                    # standard JSON input, or just its "sources" part
+                    source_files = source_json["sources"] if "sources" in source_json else source_json
+                    sources = {file_path: file_info.get("content", "") for file_path, file_info in source_files.items()}
+                    compiler_settings = source_json.get("settings", {})
                         
-                        result = {
-                            "address": address,
-                            "contract_name": contract_name,
-                            "compiler_version": compiler_version,
-                            "contract_dir": contract_dir,
-                            "main_file": main_file
-                        }
-                        
-                        return result
-                        
-                except json.JSONDecodeError:
+                except (json.JSONDecodeError, AttributeError):
                     logger.warning("failed to parse the JSON source code, try to handle it as a single file")
             
-            
-            contract_file = os.path.join(save_dir, f"{address[2:8]}_{contract_name}.sol")
-            
-            with open(contract_file, "w", encoding="utf-8") as f:
-                f.write(source_code)
-                
-            logger.info(f"save the contract's source code to: {contract_file}")
-            
-            result = {
-                "address": address,
-                "contract_name": contract_name,
-                "compiler_version": compiler_version,
-                "contract_file": contract_file
-            }
-            
-            return result
+            manifest = source_store.put(self.chain, address, contract_name, compiler_version, sources, self.find_main_file(sources, contract_name), compiler_settings)
+            logger.info(f"save the contract's source code of {address} to the source store")
+            return source_store.contract_info(manifest)
             
         except Exception as e:
             logger.error(f"error in get the contract's source code: {str(e)}")
             return None
+
+
+    # the source file declaring contract_name
+    def find_main_file(self, sources: dict, contract_name: str) -> str:
+        declaration = re.compile(rf"\b(contract|library|interface)\s+{re.escape(contract_name)}\b")
+        for file_path, content in sources.items():
+            if declaration.search(content):
+                return file_path
+        for file_path in sources.keys():
+            if contract_name in file_path or re.search(f"[^a-zA-Z0-9]{contract_name}[^a-zA-Z0-9]", file_path):
+                return file_path
+        return next(iter(sources))
         
     
     def get_slither_contract(self, contract_info):
@@ -209,6 +344,9 @@ class OnlineHelper:
             address = contract_info.get("address", "")
             if address in self.cached_contracts:
                 return self.cached_contracts[address].sli_contract
+            sli_contract = contract_cache.compiled(self.chain, address)
+            if sli_contract is not None:
+                return sli_contract
 
             compiler_version = contract_info.get("compiler_version", "")
             if not compiler_version:
@@ -216,25 +354,10 @@ class OnlineHelper:
                 return None
 
             version = compiler_version.split("+")[0]
-            
-            install_cmd = f"solc-select install {version}"
-            try:
-                result = os.system(install_cmd)
-                if result != 0:
-                    logger.error(f"Failed to install solc version {version}")
-                    return None
-            except Exception as e:
-                logger.error(f"Error installing solc version {version}: {str(e)}")
-                return None
-            
-            use_cmd = f"solc-select use {version}"
-            try:
-                result = os.system(use_cmd)
-                if result != 0:
-                    logger.error(f"Failed to switch to solc version {version}")
-                    return None
-            except Exception as e:
-                logger.error(f"Error switching to solc version {version}: {str(e)}")
+            from Compiler import load_slither, solc_binary
+            solc = solc_binary(version)
+            if solc is None:
+                logger.error(f"solc version {version} is not installed")
                 return None
             
             source_path = None
@@ -247,8 +370,11 @@ class OnlineHelper:
                 logger.error(f"Source file not found: {source_path}")
                 return None
             
-            from slither.slither import Slither
-            slither = Slither(source_path)
+            # compiled in the directory of the sources, so that imports resolve against their original paths
+            if "contract_dir" in contract_info and "main_file" in contract_info:
+                slither = load_slither(contract_info["main_file"], version, solc=solc, working_dir=contract_info["contract_dir"], remappings=contract_info.get("remappings"))
+            else:
+                slither = load_slither(source_path, version, solc=solc)
             
             contract_name = contract_info.get("contract_name")
             if not contract_name:
@@ -265,13 +391,63 @@ class OnlineHelper:
         
 
     def get4bytesinfo(self, selector):
-        if selector in selector_df.index:
-            return selector_df.loc[selector, 'text_signature']
+        text_signature = selector_index.lookup(selector)
+        if text_signature is not None:
+            return text_signature
         else:
             return "UNKNOWN"
 
 
 
+# the helper of offline mode: no chain behind it, so nothing is resolved or fetched
+class OfflineHelper(OnlineHelper):
+    def __init__(self):
+        self.chain = "offline"
+        self.rpc = None
+        self.w3 = Web3()
+        self.block_number = -1
+        self.cached_contracts = CachedContracts(self.chain, self.block_number)
+        self.var2onchain_addr = {}
+        self.getter_addresses = {}
+
+
+    def get_block_number(self):
+        return -1
+
+
+    def prefetch_getters(self, sli_contract: Contract, contract_address: str):
+        return
+
+
+    def get_contract_address(self, contract_var: Variable, context: FFuncContext, contract_address: str):
+        return None
+
+
+    def get_contract_sourcecode(self, address: str) -> dict:
+        return None
+
+
+# (chain, block) -> helper shared by the whole process, least recently used first, at most config.helper_cache_size;
+# "latest" (-1) is resolved at every request, so a long-running process never keeps serving an old block
+_helpers: "OrderedDict[tuple, OnlineHelper]" = OrderedDict()
+_helpers_lock = threading.Lock()
+
+
+def get_helper(chain: str, block_number: int) -> OnlineHelper:
+    if chain != "offline" and block_number == -1:
+        block_number = RPCClient(CHAIN_INFO[chain], session=http_session, chain=chain).block_number()
+    key = (chain, block_number)
+    with _helpers_lock:
+        helper = _helpers.get(key)
+        if helper is None:
+            helper = OfflineHelper() if chain == "offline" else OnlineHelper(chain, block_number)
+            _helpers[key] = helper
+            while len(_helpers) > settings.helper_cache_size:
+                _helpers.popitem(last=False)
+        _helpers.move_to_end(key)
+        return helper
+
+
 # ==================================== test ============================================
 
 def test_OnlineHelper():
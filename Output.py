@@ -0,0 +1,88 @@
+from typing import Any, Dict, Iterator, Optional
+import json
+import struct
+import zlib
+
+
+# per-function results (FFunction.serializeFFormulaMap) written as they come:
+#   json: one JSON object per line
+#   bin:  records of a 4-byte big-endian length followed by the zlib-compressed JSON object
+class ResultWriter:
+    MAGIC = b"FMAP\x01"
+
+    def __init__(self, path:str, format:str="json"):
+        if format not in ("json", "bin"):
+            raise ValueError(f"unknown output format {format}")
+        self.format = format
+        self.file = open(path, "wb")
+        if format == "bin":
+            self.file.write(self.MAGIC)
+        self.count = 0
+
+
+    def write(self, result:Dict[str, Any]):
+        data = json.dumps(result, separators=(",", ":")).encode("utf-8")
+        if self.format == "json":
+            self.file.write(data + b"\n")
+        else:
+            data = zlib.compress(data)
+            self.file.write(struct.pack(">I", len(data)) + data)
+        # readers may follow the file while the run goes on
+        self.file.flush()
+        self.count += 1
+
+
+    def close(self):
+        self.file.close()
+
+
+# the results of a file written by ResultWriter, in either format
+def read_results(path:str) -> Iterator[Dict[str, Any]]:
+    with open(path, "rb") as f:
+        if f.read(len(ResultWriter.MAGIC)) != ResultWriter.MAGIC:
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return
+            (size,) = struct.unpack(">I", header)
+            yield json.loads(zlib.decompress(f.read(size)))
+
+
+# set by main.py from --dump
+result_writer: Optional[ResultWriter] = None
+
+
+def open_result_writer(path:str, format:str="json"):
+    global result_writer
+    result_writer = ResultWriter(path, format)
+    return result_writer
+
+
+def write_result(result:Dict[str, Any]):
+    if result_writer is not None:
+        result_writer.write(result)
+
+
+# ==================================== test ============================================
+
+def test_ResultWriter():
+    import os
+    import tempfile
+    results = [{"contract": "AEST", "function": f"AEST.f{i}()", "formulas": [{"stateVar": "x", "smt2": [{"expression": "(+ x 1)", "constraint": "true"}]}]} for i in range(3)]
+    for format in ("json", "bin"):
+        path = os.path.join(tempfile.mkdtemp(), f"results.{format}")
+        writer = ResultWriter(path, format)
+        for result in results:
+            writer.write(result)
+        writer.close()
+        assert list(read_results(path)) == results
+    return
+
+
+if __name__ == "__main__":
+    test_ResultWriter()
@@ -0,0 +1,307 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from loguru import logger
+from requests.adapters import HTTPAdapter
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+import requests
+import config
+
+
+class RPCError(Exception):
+    def __init__(self, error:Dict[str, Any]):
+        super().__init__(f"JSON-RPC error {error.get('code')}: {error.get('message')}")
+        self.code = error.get("code")
+        self.data = error.get("data")
+
+
+# eth_call results on disk, keyed on (chain, block, to, calldata): fixed once the block is mined.
+# addresses, calldata and results are stored as raw bytes; NULL result: the call reverted
+class CallCache:
+    def __init__(self):
+        self.conn: sqlite3.Connection = None
+        self.path: str = None
+        # process that opened conn: a connection must not be used across fork(), workers open their own
+        self.pid: int = None
+        # upper bound of the number of rows: replaced rows and other processes' writes are only seen when recounting
+        self.rows = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def open(self) -> bool:
+        if not config.call_cache_path:
+            return False
+        if self.pid != os.getpid():
+            # inherited from the parent, left untouched (closing it could disturb the parent's transactions)
+            self.conn = None
+            self.lock = threading.Lock()
+        if self.conn is not None and self.path == config.call_cache_path:
+            return True
+        self.path = config.call_cache_path
+        self.pid = os.getpid()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS calls (chain TEXT, block INTEGER, target BLOB, data BLOB, result BLOB, used REAL, PRIMARY KEY (chain, block, target, data)) WITHOUT ROWID")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS calls_used ON calls (used)")
+        self.rows = self.conn.execute("SELECT COUNT(*) FROM calls").fetchone()[0]
+        return True
+
+
+    # (to, data) -> (result,) for the cached calls; a missing key is a miss
+    def lookup(self, chain:str, block:int, calls:List[Tuple[str, str]]) -> Dict[Tuple[str, str], Tuple[Optional[bytes]]]:
+        found = {}
+        if block < 0 or not self.open():
+            return found
+        now = time.time()
+        with self.lock:
+            for to, data in calls:
+                key = (chain, block, _raw(to), _raw(data))
+                row = self.conn.execute("SELECT result FROM calls WHERE chain = ? AND block = ? AND target = ? AND data = ?", key).fetchone()
+                if row is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                found[(to, data)] = (row[0],)
+                self.conn.execute("UPDATE calls SET used = ? WHERE chain = ? AND block = ? AND target = ? AND data = ?", (now, *key))
+            self.conn.commit()
+        return found
+
+
+    def store(self, chain:str, block:int, results:Dict[Tuple[str, str], Optional[bytes]]):
+        if block < 0 or not results or not self.open():
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO calls VALUES (?, ?, ?, ?, ?, ?)", [(chain, block, _raw(to), _raw(data), result, now) for (to, data), result in results.items()])
+            self.rows += len(results)
+            if self.rows > config.call_cache_size:
+                self.rows = self.conn.execute("SELECT COUNT(*) FROM calls").fetchone()[0]
+            # evict the least recently used, 10% below the limit so that the next inserts don't count again
+            if self.rows > config.call_cache_size:
+                keep = config.call_cache_size - config.call_cache_size // 10
+                self.conn.execute("DELETE FROM calls WHERE (chain, block, target, data) IN (SELECT chain, block, target, data FROM calls ORDER BY used LIMIT ?)", (self.rows - keep,))
+                self.rows = keep
+            self.conn.commit()
+
+
+    def __str__(self):
+        return f"call cache: {self.hits} hits, {self.misses} misses"
+
+
+def _raw(hex_string:str) -> bytes:
+    return bytes.fromhex(hex_string[2:] if hex_string.startswith("0x") else hex_string)
+
+
+call_cache = CallCache()
+
+
+# keep-alive session, shared by every request to the same host
+def make_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=config.rpc_pool_size, pool_maxsize=config.rpc_pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# explorer APIs (getsourcecode, ...)
+http_session = make_session()
+
+
+class RPCClient:
+    def __init__(self, url:str, session:requests.Session=None, chain:str=None):
+        self.url = url
+        # results of eth_call at a fixed block are cached under this name
+        self.chain = chain
+        self.session = session if session is not None else make_session()
+        self.ids = itertools.count(1)
+        self.round_trips = 0
+        self.requests = 0
+
+
+    def _post(self, payload):
+        response = self.session.post(self.url, json=payload, timeout=config.rpc_timeout)
+        response.raise_for_status()
+        self.round_trips += 1
+        return response.json()
+
+
+    def request(self, method:str, params:List[Any]) -> Any:
+        self.requests += 1
+        reply = self._post({"jsonrpc": "2.0", "id": next(self.ids), "method": method, "params": params})
+        if "error" in reply:
+            raise RPCError(reply["error"])
+        return reply["result"]
+
+
+    # one round-trip per config.rpc_batch_size calls; a failed call gives its RPCError in place of the result
+    def batch(self, calls:List[Tuple[str, List[Any]]]) -> List[Any]:
+        results = []
+        for start in range(0, len(calls), config.rpc_batch_size):
+            chunk = calls[start:start + config.rpc_batch_size]
+            ids = [next(self.ids) for _ in chunk]
+            self.requests += len(chunk)
+            replies = self._post([{"jsonrpc": "2.0", "id": id, "method": method, "params": params} for id, (method, params) in zip(ids, chunk)])
+            # a node may answer a whole batch with a single error
+            if isinstance(replies, dict):
+                results.extend(RPCError(replies.get("error", {})) for _ in chunk)
+                continue
+            # replies of a batch come in any order
+            by_id = {reply.get("id"): reply for reply in replies}
+            for id in ids:
+                reply = by_id.get(id, {"error": {"code": -32603, "message": "missing reply in batch"}})
+                results.append(RPCError(reply["error"]) if "error" in reply else reply["result"])
+        return results
+
+
+    def block_number(self) -> int:
+        return int(self.request("eth_blockNumber", []), 16)
+
+
+    # None for a call that reverted or failed
+    def eth_calls(self, calls:List[Tuple[str, str]], block_number:int) -> List[Optional[bytes]]:
+        cached = call_cache.lookup(self.chain, block_number, calls) if self.chain else {}
+        missing = list(dict.fromkeys(call for call in calls if call not in cached))
+        block = hex(block_number) if block_number >= 0 else "latest"
+        results = self.batch([("eth_call", [{"to": to, "data": data}, block]) for to, data in missing]) if missing else []
+        fetched = {}
+        for (to, data), result in zip(missing, results):
+            if isinstance(result, RPCError):
+                logger.warning(f"eth_call {data} to {to} failed: {result}")
+                # a revert is as final as a result, other errors (rate limits, ...) are not
+                if result.code == 3 or "revert" in str(result):
+                    fetched[(to, data)] = None
+                cached[(to, data)] = (None,)
+            else:
+                fetched[(to, data)] = _raw(result)
+                cached[(to, data)] = (fetched[(to, data)],)
+        if self.chain:
+            call_cache.store(self.chain, block_number, fetched)
+        return [cached[call][0] for call in calls]
+
+
+    def eth_call(self, to:str, data:str, block_number:int) -> Optional[bytes]:
+        return self.eth_calls([(to, data)], block_number)[0]
+
+
+    def __str__(self):
+        return f"rpc {self.url}: {self.requests} requests in {self.round_trips} round-trips"
+
+
+# ==================================== test ============================================
+
+# answers eth_call from a table of (to, data) -> result, for tests without a node
+class StubRPCServer:
+    def __init__(self, calls:Dict[Tuple[str, str], str]=None, block_number:int=1):
+        self.calls = {(to.lower(), data.lower()): result for (to, data), result in (calls or {}).items()}
+        self.block_number = block_number
+        self.posts = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+
+    def answer(self, request:Dict[str, Any]) -> Dict[str, Any]:
+        reply = {"jsonrpc": "2.0", "id": request.get("id")}
+        if request.get("method") == "eth_blockNumber":
+            reply["result"] = hex(self.block_number)
+        elif request.get("method") == "eth_call":
+            tx = request["params"][0]
+            key = (tx["to"].lower(), tx["data"].lower())
+            if key in self.calls:
+                reply["result"] = self.calls[key]
+            else:
+                reply["error"] = {"code": -32000, "message": "execution reverted"}
+        else:
+            reply["error"] = {"code": -32601, "message": "method not found"}
+        return reply
+
+
+    def _handler(self) -> Callable:
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                stub.posts += 1
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                reply = [stub.answer(request) for request in payload] if isinstance(payload, list) else stub.answer(payload)
+                body = json.dumps(reply).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def test_RPCClient():
+    token = "0x40eD17221b3B2D8455F4F1a05CAc6b77c5f707e3"
+    pair = "0x" + "00" * 12 + "11" * 20
+    router = "0x" + "00" * 12 + "22" * 20
+    with StubRPCServer({(token, "0xa8aa1b31"): pair, (token, "0xf887ea40"): router}, block_number=100) as stub:
+        client = RPCClient(stub.url)
+        assert client.block_number() == 100
+        results = client.eth_calls([(token, "0xa8aa1b31"), (token, "0xf887ea40"), (token, "0xdeadbeef")], 100)
+        assert results == [bytes.fromhex(pair[2:]), bytes.fromhex(router[2:]), None]
+        # blockNumber + a single batch
+        assert stub.posts == 2
+        print(client)
+    return
+
+
+def test_CallCache():
+    import tempfile
+    token = "0x40eD17221b3B2D8455F4F1a05CAc6b77c5f707e3"
+    pair = "0x" + "00" * 12 + "11" * 20
+    config.call_cache_path = os.path.join(tempfile.mkdtemp(), "calls.sqlite")
+    with StubRPCServer({(token, "0xa8aa1b31"): pair}) as stub:
+        client = RPCClient(stub.url, chain="bnb")
+        first = client.eth_calls([(token, "0xa8aa1b31"), (token, "0xdeadbeef")], 100)
+        second = client.eth_calls([(token, "0xa8aa1b31"), (token, "0xdeadbeef")], 100)
+        assert first == second == [bytes.fromhex(pair[2:]), None]
+        # the revert is cached as well
+        assert stub.posts == 1
+        # another block is another key
+        client.eth_calls([(token, "0xa8aa1b31")], 101)
+        assert stub.posts == 2
+        print(call_cache)
+    # the least recently used results are trimmed to 10% below the limit
+    config.call_cache_size = 10
+    for block in range(200, 211):
+        call_cache.store("bnb", block, {(token, "0xa8aa1b31"): b""})
+    assert call_cache.rows == 10 == call_cache.conn.execute("SELECT COUNT(*) FROM calls").fetchone()[0]
+    assert call_cache.lookup("bnb", 100, [(token, "0xa8aa1b31")]) == {}
+    return
+
+
+if __name__ == "__main__":
+    test_RPCClient()
+    test_CallCache()
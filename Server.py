@@ -0,0 +1,149 @@
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Tuple
+from loguru import logger
+from web3 import Web3
+import json
+import os
+import socketserver
+import threading
+import time
+import config
+
+
+# keeps the helpers (see Helper.get_helper) with their compiled contracts, summaries, solver caches and results of finished analyses
+# warm between requests; analyses run one at a time, Z3 and the FFunction state are not thread-safe
+class AnalysisService:
+    def __init__(self):
+        # (chain, block number, address, functions) -> result
+        self.results: "OrderedDict[Tuple, Dict[str, Any]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.result_hits = 0
+
+
+    def analyze(self, job:Dict[str, Any]) -> Dict[str, Any]:
+        from Contract import analyze_functions, load_online_contract
+        from Helper import get_helper
+        chain, address = job.get("chain"), job.get("address")
+        if not chain or not address or not Web3.is_address(address):
+            raise ValueError("a job needs a chain and a valid address")
+        address = Web3.to_checksum_address(address)
+        block = int(job.get("block", -1))
+        functions = tuple(sorted(job["functions"])) if job.get("functions") else None
+
+        with self.lock:
+            self.requests += 1
+            start = time.time()
+            helper = get_helper(chain, block)
+            # block -1 ("latest") is resolved by get_helper
+            key = (chain, helper.block_number, address, functions)
+            if key in self.results:
+                self.results.move_to_end(key)
+                self.result_hits += 1
+                return self.results[key]
+            fcontract = load_online_contract(helper, address)
+            selected = [func for func in fcontract.sli_contract.functions if functions is None or func.canonical_name in functions]
+            result = {
+                "chain": chain,
+                "block": helper.block_number,
+                "address": address,
+                "contract": fcontract.main_name,
+                "functions": analyze_functions(fcontract, selected),
+            }
+            self.results[key] = result
+            while len(self.results) > config.server_results_size:
+                self.results.popitem(last=False)
+            logger.info(f"analyzed {address} on {chain} in {time.time() - start:.3f}s")
+            return result
+
+
+    def stats(self) -> Dict[str, Any]:
+        from FFormula import simplify_cache
+        from FSolver import constraint_cache
+        from FSummary import summaries
+        from Helper import _helpers, contract_cache
+        return {
+            "requests": self.requests,
+            "result_hits": self.result_hits,
+            "cached_results": len(self.results),
+            "helpers": [{"chain": chain, "block": block, "contracts": len(helper.cached_contracts)} for (chain, block), helper in list(_helpers.items())],
+            "contracts": len(contract_cache.entries),
+            "summaries": len(summaries),
+            "constraint_cache": str(constraint_cache),
+            "simplify_cache": str(simplify_cache),
+        }
+
+
+def make_handler(service:AnalysisService):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, status:int, body:Dict[str, Any]):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self.reply(200, service.stats())
+            else:
+                self.reply(404, {"error": f"unknown path {self.path}"})
+
+
+        # POST /analyze {"chain": ..., "address": ..., "block": ..., "functions": [...]}
+        def do_POST(self):
+            if self.path != "/analyze":
+                self.reply(404, {"error": f"unknown path {self.path}"})
+                return
+            try:
+                job = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                self.reply(200, service.analyze(job))
+            except (ValueError, KeyError) as e:
+                self.reply(400, {"error": str(e)})
+            except Exception as e:
+                logger.error(f"Failed job {self.path}: {e}")
+                self.reply(500, {"error": str(e)})
+
+
+        def log_message(self, format, *args):
+            logger.debug(f"[server] {format % args}")
+
+    return Handler
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ("unix", 0)
+
+
+# address: host:port, or unix:/path/to/socket
+def Serve(address:str):
+    # forking a process pool from a threaded server may copy locks held by other request threads,
+    # and the workers need the contract by fork (see Contract.iter_analyze_functions), so functions are analyzed in the request thread
+    if config.jobs > 1:
+        logger.warning(f"--jobs {config.jobs} is ignored by the server")
+        config.jobs = 1
+    service = AnalysisService()
+    handler = make_handler(service)
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.remove(path)
+        server = UnixHTTPServer(path, handler)
+    else:
+        host, _, port = address.rpartition(":")
+        server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), handler)
+    logger.info(f"serving analysis jobs on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,241 @@
+from typing import Any, Dict, List, Optional
+from loguru import logger
+import argparse
+import hashlib
+import io
+import json
+import os
+import posixpath
+import re
+import tarfile
+import config
+
+
+# explorer sources on disk, consulted before the explorer:
+#   blobs/<sha256>                 content of one source file
+#   index/<chain>/<address>.json   manifest: contract name, compiler, settings, original path -> blob
+#   work/<chain>/<address>/...     the sources checked out under their original paths, for the compiler
+class SourceStore:
+    def __init__(self, root:str=None):
+        self._root = root
+
+
+    # without an explicit root (Store.py --store), whatever config.source_store_dir is when the store is used
+    @property
+    def root(self) -> str:
+        return self._root or config.source_store_dir
+
+
+    def blob_path(self, digest:str) -> str:
+        return os.path.join(self.root, "blobs", digest)
+
+
+    def manifest_path(self, chain:str, address:str) -> str:
+        _check_key(chain, address)
+        return os.path.join(self.root, "index", chain, f"{address.lower()}.json")
+
+
+    def work_dir(self, chain:str, address:str) -> str:
+        _check_key(chain, address)
+        return os.path.join(self.root, "work", chain, address.lower())
+
+
+    def put_blob(self, content:str) -> str:
+        data = content.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            _write_atomic(path, data)
+        return digest
+
+
+    def get_blob(self, digest:str) -> str:
+        with open(self.blob_path(digest), "rb") as f:
+            return f.read().decode("utf-8")
+
+
+    def put(self, chain:str, address:str, contract_name:str, compiler_version:str, sources:Dict[str, str], main_file:str, settings:Dict[str, Any]=None) -> Dict[str, Any]:
+        manifest = {
+            "chain": chain,
+            "address": address,
+            "contract_name": contract_name,
+            "compiler_version": compiler_version,
+            "main_file": main_file,
+            "settings": settings or {},
+            "sources": {path: self.put_blob(content) for path, content in sources.items()},
+        }
+        _write_atomic(self.manifest_path(chain, address), json.dumps(manifest, indent=1).encode())
+        return manifest
+
+
+    def get(self, chain:str, address:str) -> Optional[Dict[str, Any]]:
+        path = self.manifest_path(chain, address)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            manifest = json.load(f)
+        if not all(os.path.exists(self.blob_path(digest)) for digest in manifest["sources"].values()):
+            logger.warning(f"incomplete source store entry for {address} on {chain}")
+            return None
+        return manifest
+
+
+    # the sources of the manifest under their original paths, rewritten only when a blob changed
+    def checkout(self, manifest:Dict[str, Any]) -> str:
+        work_dir = self.work_dir(manifest["chain"], manifest["address"])
+        for path, digest in manifest["sources"].items():
+            out_path = os.path.join(work_dir, _safe_path(path))
+            if os.path.exists(out_path):
+                with open(out_path, "rb") as f:
+                    if hashlib.sha256(f.read()).hexdigest() == digest:
+                        continue
+            _write_atomic(out_path, self.get_blob(digest).encode("utf-8"))
+        return work_dir
+
+
+    # what OnlineHelper.get_contract_sourcecode returns for a stored contract
+    def contract_info(self, manifest:Dict[str, Any]) -> Dict[str, Any]:
+        work_dir = self.checkout(manifest)
+        main_file = _safe_path(manifest["main_file"])
+        return {
+            "address": manifest["address"],
+            "contract_name": manifest["contract_name"],
+            "compiler_version": manifest["compiler_version"],
+            "contract_dir": work_dir,
+            "main_file": main_file,
+            "contract_file": os.path.join(work_dir, main_file),
+            "remappings": manifest["settings"].get("remappings", []),
+        }
+
+
+    def manifests(self, chain:str=None) -> List[Dict[str, Any]]:
+        index_dir = os.path.join(self.root, "index")
+        if not os.path.isdir(index_dir):
+            return []
+        manifests = []
+        for chain_name in sorted(os.listdir(index_dir)):
+            if chain is not None and chain_name != chain:
+                continue
+            for name in sorted(os.listdir(os.path.join(index_dir, chain_name))):
+                with open(os.path.join(index_dir, chain_name, name), "r") as f:
+                    manifests.append(json.load(f))
+        return manifests
+
+
+    # one tar.gz of the manifests and the blobs they use
+    def export(self, archive:str, chain:str=None) -> int:
+        manifests = self.manifests(chain)
+        digests = sorted({digest for manifest in manifests for digest in manifest["sources"].values()})
+        with tarfile.open(archive, "w:gz") as tar:
+            for manifest in manifests:
+                _add_bytes(tar, f"index/{manifest['chain']}/{manifest['address'].lower()}.json", json.dumps(manifest, indent=1).encode())
+            for digest in digests:
+                tar.add(self.blob_path(digest), arcname=f"blobs/{digest}")
+        logger.info(f"exported {len(manifests)} contracts ({len(digests)} source files) to {archive}")
+        return len(manifests)
+
+
+    def import_(self, archive:str) -> int:
+        count = 0
+        with tarfile.open(archive, "r:gz") as tar:
+            for member in tar.getmembers():
+                if not member.isfile():
+                    continue
+                data = tar.extractfile(member).read()
+                parts = member.name.split("/")
+                if len(parts) == 2 and parts[0] == "blobs":
+                    # content-addressed, so a blob is checked against its name
+                    if hashlib.sha256(data).hexdigest() != parts[1]:
+                        logger.warning(f"skip corrupted blob {parts[1]}")
+                        continue
+                    _write_atomic(self.blob_path(parts[1]), data)
+                elif len(parts) == 3 and parts[0] == "index" and parts[2].endswith(".json"):
+                    manifest = json.loads(data)
+                    try:
+                        path = self.manifest_path(manifest["chain"], manifest["address"])
+                    except (KeyError, TypeError, ValueError) as e:
+                        logger.warning(f"skip invalid manifest {member.name}: {e}")
+                        continue
+                    _write_atomic(path, data)
+                    count += 1
+        logger.info(f"imported {count} contracts from {archive}")
+        return count
+
+
+# chain and address name directories of the store, an archive must not pick paths outside of it
+def _check_key(chain:str, address:str):
+    if not isinstance(chain, str) or not re.fullmatch(r"[A-Za-z0-9_-]+", chain):
+        raise ValueError(f"invalid chain name {chain!r}")
+    if not isinstance(address, str) or not re.fullmatch(r"0x[0-9a-fA-F]{40}", address):
+        raise ValueError(f"invalid address {address!r}")
+
+
+def _safe_path(path:str) -> str:
+    # keep explorer paths (e.g. @openzeppelin/contracts/token/ERC20/ERC20.sol) inside the work directory
+    parts = [part for part in posixpath.normpath(path.replace("\\", "/").replace(":", "_")).split("/") if part not in ("", ".", "..")]
+    return os.path.join(*parts) if parts else "main.sol"
+
+
+def _write_atomic(path:str, data:bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _add_bytes(tar:tarfile.TarFile, name:str, data:bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+source_store = SourceStore()
+
+
+# ==================================== test ============================================
+
+def test_SourceStore():
+    import tempfile
+    store = SourceStore(tempfile.mkdtemp())
+    sources = {
+        "contracts/Token.sol": 'import "@openzeppelin/contracts/token/ERC20/ERC20.sol";\ncontract Token is ERC20 {}',
+        "@openzeppelin/contracts/token/ERC20/ERC20.sol": "contract ERC20 {}",
+    }
+    address = "0x40eD17221b3B2D8455F4F1a05CAc6b77c5f707e3"
+    store.put("bnb", address, "Token", "0.8.19+commit.7dd6d404", sources, "contracts/Token.sol", {"remappings": []})
+    info = store.contract_info(store.get("bnb", address))
+    with open(os.path.join(info["contract_dir"], "@openzeppelin/contracts/token/ERC20/ERC20.sol")) as f:
+        assert f.read() == "contract ERC20 {}"
+    assert info["contract_file"].endswith(os.path.join("contracts", "Token.sol"))
+
+    archive = os.path.join(tempfile.mkdtemp(), "store.tar.gz")
+    assert store.export(archive) == 1
+    other = SourceStore(tempfile.mkdtemp())
+    assert other.import_(archive) == 1
+    assert other.get("bnb", address)["sources"] == store.get("bnb", address)["sources"]
+    assert other.get("eth", address) is None
+    # manifests pointing outside the store are skipped
+    with tarfile.open(archive, "w:gz") as tar:
+        _add_bytes(tar, "index/bnb/evil.json", json.dumps({"chain": "../..", "address": address}).encode())
+    assert other.import_(archive) == 0
+    print(info)
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="import/export the local store of explorer sources")
+    parser.add_argument("action", choices=["import", "export", "test"])
+    parser.add_argument("archive", nargs="?", help="tar.gz archive to read or write")
+    parser.add_argument("--chain", help="[export only] only export the contracts of this chain")
+    parser.add_argument("--store", help=f"store directory (default {config.source_store_dir})")
+    args = parser.parse_args()
+    store = SourceStore(args.store)
+    if args.action == "test":
+        test_SourceStore()
+    elif not args.archive:
+        parser.error(f"{args.action} requires an archive")
+    elif args.action == "export":
+        store.export(args.archive, args.chain)
+    else:
+        store.import_(args.archive)
@@ -1,3 +1,67 @@
 # Global configuration parameters
 refined = False
-max_iter = 100 
\ No newline at end of file
+max_iter = 100
+# max number of simplified constraints whose satisfiability is memoized
+constraint_cache_size = 65536
+# max number of terms whose simplified form is memoized
+simplify_cache_size = 65536
+# max number of expressions of one variable before they are widened into one, 0 means unbounded
+max_fanout = 0
+# how expressions are widened: ite (one If chain over the constraints) | havoc (a fresh symbol)
+widening = "ite"
+# check path feasibility with solver scopes that follow the condition stack
+incremental = False
+# order of the work list: bfs | dfs | priority
+search = "bfs"
+# max number of explored paths per function, 0 means unbounded
+max_paths = 0
+# summarize loops from their first iterations instead of unrolling them up to max_iter
+loop_summary = False
+# iterations unrolled before a loop is summarized (at least 2)
+loop_unroll = 2
+# merge the contexts of both branches at ENDIF
+merge_states = False
+# analyze internal/library callees once and instantiate their summaries at call sites
+summaries = False
+# max number of callee summaries kept in memory
+summary_cache_size = 4096
+# give up a summary (and analyze inline) above this many argument combinations
+summary_max_instances = 64
+# canonical names of the functions to analyze, None means all of them
+functions = None
+# number of worker processes analyzing the functions of a contract
+jobs = 1
+# directory of the compilation cache, None disables it
+compile_cache_dir = "./.compile_cache"
+# max total size in bytes of the cached compilations
+compile_cache_size = 1 << 30
+# max number of JSON-RPC calls sent in one batch request
+rpc_batch_size = 100
+# keep-alive connections kept per host
+rpc_pool_size = 16
+# seconds to wait for an RPC/explorer reply
+rpc_timeout = 30
+# sqlite file caching eth_call results per (chain, block), None disables it
+call_cache_path = "./.call_cache.sqlite"
+# max number of cached eth_call results
+call_cache_size = 1000000
+# download and compile the statically known callees of a contract before analyzing it
+prefetch_callees = True
+# max number of callee sources downloaded at the same time
+prefetch_concurrency = 4
+# local store of the sources downloaded from explorers
+source_store_dir = "./.source_store"
+# extra directories holding solc-<version> binaries, searched after solc-select's artifacts
+solc_dirs = []
+# install missing solc versions through solc-select
+solc_install = True
+# number of addresses of a batch file analyzed at the same time
+batch_workers = 4
+# max number of analysis results kept by the server
+server_results_size = 1024
+# max number of contracts (with their compilation) kept in memory, shared by all helpers
+contract_cache_size = 256
+# max number of (chain, block) helpers kept in memory
+helper_cache_size = 16
+# directory the effects of each contract are written to (aest.json schema), None: not classified
+effects_dir = None
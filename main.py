@@ -1,7 +1,11 @@
 import argparse
 import sys
 from loguru import logger
+from Batch import BatchBuild
+from Output import open_result_writer
+from Server import Serve
 from Contract import BuildFormula, FContract, OnlineBuild
+from Helper import CHAIN_INFO
 from typing import List
 import config
 
@@ -30,6 +34,30 @@ parser.add_argument(
     help="Contract addresses on chain. Required in online mode. Example: -addr addr1 addr2 addr3"
 )
 
+parser.add_argument(
+    "--batch",
+    metavar="FILE",
+    help="[Online mode only] Analyze the addresses listed in a JSONL (address, chain, block) or CSV file instead of --addresses"
+)
+
+parser.add_argument(
+    "-o", "--output",
+    help="[Batch only] JSONL file the per-address results are appended to, addresses already in it are skipped. Default: <FILE>.results.jsonl"
+)
+
+parser.add_argument(
+    "--batch_workers",
+    type=int,
+    default=4,
+    help="[Batch only] number of addresses analyzed at the same time"
+)
+
+parser.add_argument(
+    "--serve",
+    metavar="ADDRESS",
+    help="[Online mode only] Run as a daemon answering POST /analyze {chain, address, block, functions} with caches kept warm. ADDRESS: host:port or unix:/path/to/socket"
+)
+
 parser.add_argument(
     "-b", "--block",
     type=int,
@@ -57,12 +85,130 @@ parser.add_argument(
     help="maximum number of iterations"
 )
 
+parser.add_argument(
+    "--search",
+    choices=["bfs", "dfs", "priority"],
+    default="bfs",
+    help="path exploration order, 'priority' favors paths that write state variables"
+)
+
+parser.add_argument(
+    "--max_paths",
+    type=int,
+    default=0,
+    help="maximum number of explored paths per function (0 means unbounded), partial results are kept"
+)
+
+parser.add_argument(
+    "--loop_summary",
+    action="store_true",
+    help="summarize loops (induction variables, accumulators, widening for the rest) after --loop_unroll iterations instead of unrolling them up to --max_iter"
+)
+
+parser.add_argument(
+    "--loop_unroll",
+    type=int,
+    default=2,
+    help="[--loop_summary only] iterations unrolled before a loop is summarized (at least 2)"
+)
+
+parser.add_argument(
+    "--max_fanout",
+    type=int,
+    default=0,
+    help="maximum number of expressions per variable, more are widened and the formula is marked approximated (default 0: unbounded)"
+)
+
+parser.add_argument(
+    "--widening",
+    choices=["ite", "havoc"],
+    default="ite",
+    help="how expressions over --max_fanout are widened: one if-then-else chain, or a fresh symbol"
+)
+
+parser.add_argument(
+    "--merge",
+    action="store_true",
+    help="merge the states of both branches of an if statement at its join point"
+)
+
+parser.add_argument(
+    "--summary",
+    action="store_true",
+    help="summarize internal and library callees once and reuse the summaries at every call site"
+)
+
+parser.add_argument(
+    "-f", "--functions",
+    nargs="+",
+    help="canonical names of the functions to analyze (all functions by default). Example: -f 'AEST._transfer(address,address,uint256)'"
+)
+
+parser.add_argument(
+    "-j", "--jobs",
+    type=int,
+    default=1,
+    help="number of worker processes analyzing the functions of a contract in parallel (ignored by --serve)"
+)
+
+parser.add_argument(
+    "--no_compile_cache",
+    action="store_true",
+    help="always recompile the sources instead of reusing the compilations cached in ./.compile_cache"
+)
+
+parser.add_argument(
+    "--no_call_cache",
+    action="store_true",
+    help="[Online mode only] always query the node instead of reusing the eth_call results cached in ./.call_cache.sqlite"
+)
+
+parser.add_argument(
+    "--no_prefetch",
+    action="store_true",
+    help="[Online mode only] fetch callee contracts only when the analysis reaches the call"
+)
+
+parser.add_argument(
+    "--dump",
+    metavar="FILE",
+    help="write the formulas of each function to FILE as soon as it is analyzed, expressions and constraints in SMT-LIB2"
+)
+
+parser.add_argument(
+    "--dump_format",
+    choices=["json", "bin"],
+    default="json",
+    help="format of --dump: one JSON object per line, or length-prefixed zlib-compressed JSON records"
+)
+
+parser.add_argument(
+    "--effects",
+    metavar="DIR",
+    help="classify the effect of each function on each state variable (increase, decrease, reset, change) and write DIR/<contract>.json"
+)
+
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    help="check path constraints incrementally with solver scopes that follow the branch conditions"
+)
+
 args = parser.parse_args()
 
 # 参数验证
 if args.mode == "online":
-    if not args.chain or not args.addresses:
+    if args.serve:
+        if args.addresses or args.batch:
+            parser.error("--serve takes the addresses from the requests")
+    elif args.batch:
+        if args.addresses:
+            parser.error("--batch replaces the --addresses argument")
+    elif not args.chain or not args.addresses:
         parser.error("Online mode requires both --chain and --addresses arguments")
+    # with --batch, --chain is only the default of the rows that don't name their chain
+    if args.chain and args.chain not in CHAIN_INFO:
+        parser.error(f"unknown chain {args.chain!r}, add its RPC url to the [rpc] section of config.toml")
     if args.contracts:
         parser.error("Online mode does not accept --contracts argument, please use --addresses instead")
     contract_pairs = []
@@ -72,6 +218,8 @@ if args.mode == "online":
         "block": args.block if args.block is not None else -1
     }
 else:  # offline mode
+    if args.batch or args.serve:
+        parser.error("--batch and --serve arguments are only valid in online mode")
     if args.block is not None:
         parser.error("--block argument is only valid in online mode")
     if not args.contracts:
@@ -99,14 +247,38 @@ if __name__ == "__main__":
     # Update global config
     config.refined = args.refined
     config.max_iter = args.max_iter
+    config.incremental = args.incremental
+    config.search = args.search
+    config.max_paths = args.max_paths
+    config.loop_summary = args.loop_summary
+    config.loop_unroll = args.loop_unroll
+    config.max_fanout = args.max_fanout
+    config.widening = args.widening
+    config.merge_states = args.merge
+    config.summaries = args.summary
+    config.functions = set(args.functions) if args.functions else None
+    config.jobs = args.jobs
+    if args.no_compile_cache:
+        config.compile_cache_dir = None
+    if args.no_call_cache:
+        config.call_cache_path = None
+    config.prefetch_callees = not args.no_prefetch
+    config.batch_workers = args.batch_workers
+    config.effects_dir = args.effects
     config.mode = args.mode
     config.chain_info = chain_info
 
     # set log level
     logger.add("./log", level="DEBUG")
+    if args.dump:
+        open_result_writer(args.dump, args.dump_format)
     global analyzed_contracts
     analyzed_contracts: List[FContract] = []
-    if config.mode == "online":
+    if args.serve:
+        Serve(args.serve)
+    elif args.batch:
+        BatchBuild(args.batch, args.output or f"{args.batch}.results.jsonl", args.chain, chain_info["block"])
+    elif config.mode == "online":
         OnlineBuild(config.chain_info)
     else:
         BuildFormula(contract_pairs)
\ No newline at end of file